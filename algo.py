@@ -1,6 +1,11 @@
-from graph import Graph
-from utils import lat_long_dist, day_of_week
+from graph import Graph, CSRGraph
+from utils import lat_long_dist_to_many, lat_long_dist_within
+from hours import HoursIndex
+from categories import CategoryMasks, default_category_index
+from timing import Timeline, TimingTable
 import datetime
+import time
+import numpy as np
 
 class EntityTypes:
     BUSINESS = 0
@@ -9,23 +14,65 @@ class EntityTypes:
 
 
 class PlanState:
-    def __init__(self, node, start_dt, end_dt, prev_state, num_prev_states):
+    def __init__(self, node, start, end, prev_state, num_prev_states, timeline):
+        """
+        :param start: Arrival time, in minutes on the timeline.
+        :param end: Departure time, in minutes on the timeline.
+        :param timeline: The Timeline the plan's times are on (shared by every state in a search).
+        """
         self.node = node
-        self.start_dt = start_dt
-        self.end_dt = end_dt
+        self.start = start
+        self.end = end
+        self.timeline = timeline
         self.num_prev_states = num_prev_states
         self.prev_state = prev_state
         self._prev_state_list = None
+        self._visited_ids = None
+        # States that generate_plans merged into this one (see state_key_fn there). Each is an alternative to
+        # this state: same place and end time, different plan before it, same possible plans after it.
+        self.merged_states = None
 
     def prev_state_list(self):
-        out = []
-        s = self.prev_state
-        while s is not None:
-            out.append(s)
-            s = s.prev_state
-        self._prev_state_list = out[::-1]
+        """
+        Returns the states before this one, first to last. The list is cached, so don't modify it.
+        """
+        if self._prev_state_list is None:
+            out = []
+            s = self.prev_state
+            while s is not None:
+                out.append(s)
+                s = s.prev_state
+            self._prev_state_list = out[::-1]
         return self._prev_state_list
 
+    @property
+    def start_dt(self):
+        return self.timeline.to_datetime(self.start)
+
+    @property
+    def end_dt(self):
+        return self.timeline.to_datetime(self.end)
+
+    @property
+    def visited_ids(self):
+        """
+        Frozen set of the ids of every entity visited in the plan up to and including this state.
+        Built from the previous state's set the first time it's needed, so checking whether a place has been
+        visited is O(1) and the set is only built once per state that gets expanded.
+        """
+        if self._visited_ids is None:
+            prev_ids = self.prev_state.visited_ids if self.prev_state is not None else frozenset()
+            self._visited_ids = prev_ids | {self.node.entity.id}
+        return self._visited_ids
+
+    def has_visited(self, entity_id):
+        return entity_id in self.visited_ids
+
+    def add_merged_state(self, state):
+        if self.merged_states is None:
+            self.merged_states = []
+        self.merged_states.append(state)
+
 class ConstraintParams:
     def __init__(self, graph, curr_state, next_state, global_memory):
         self.graph = graph
@@ -35,13 +82,18 @@ class ConstraintParams:
 
 
 class Entity:
-    def __init__(self, business=None, event=None):
+    def __init__(self, business=None, event=None, category_index=None):
         self.open_times = {}
         self.close_times = {}
         self.start_dt = None
         self.end_dt = None
         self.spans_days = False # For events across multiple days where time will be unclear
         self.entity = business if business is not None else event
+        self._hours_index = None
+        self._event_span = None
+        # Index the entity's categories are interned in, see category_mask
+        self.category_index = category_index if category_index is not None else default_category_index()
+        self._category_mask = None
 
         self.type = EntityTypes.BUSINESS if business is not None else EntityTypes.EVENT
         if business is not None:
@@ -55,27 +107,72 @@ class Entity:
     def hours_open(self, dt):
         pass
 
+    @property
+    def hours_index(self):
+        """
+        The business hours compiled into a HoursIndex (built on first use).
+        """
+        if self._hours_index is None:
+            self.compile_hours()
+        return self._hours_index
+
+    def compile_hours(self):
+        """
+        (Re)builds the hours index. Call this if the underlying business hours change.
+        """
+        if self.type == EntityTypes.BUSINESS:
+            self._hours_index = HoursIndex(self.entity.hours)
+
+    @property
+    def category_mask(self):
+        """
+        The entity's categories as a bitmask from its category_index (built on first use).
+        """
+        if self._category_mask is None:
+            self._category_mask = self.category_index.mask(self.entity.categories)
+        return self._category_mask
+
     def open_at(self, dt):
-        is_open = False
         # If it's an event, check that we're between the start and end times
         if self.type == EntityTypes.EVENT:
-            if self.start_dt <= dt <= self.end_dt:
-                is_open = True
+            return self.start_dt <= dt <= self.end_dt
         # Otherwise check that it's between business hours
-        else:
-            weekday = day_of_week(dt)
-            tm = dt.time()
-            # Check that we're in at least one of the timespans
-            for hours in self.entity.hours[weekday]:
-                # Between start and end hours and it isn't overnight OR
-                # between an overnight start + end date
-                if (hours['start'] <= tm <= hours['end']
-                        and not hours['is_overnight']) \
-                        or ((hours['start'] <= tm or tm <= hours['end'])
-                            and hours['is_overnight']):
-                    is_open = True
-                    break
-        return is_open
+        return (self._hours_index or self.hours_index).open_at(dt)
+
+    def open_between(self, start_dt, end_dt):
+        """
+        True if open for the whole time from start_dt to end_dt (not just at both ends).
+        """
+        if self.type == EntityTypes.EVENT:
+            return self.start_dt <= start_dt and end_dt <= self.end_dt
+        return (self._hours_index or self.hours_index).open_between(start_dt, end_dt)
+
+    def _event_minutes(self, timeline):
+        # The event's first and last whole minutes on the timeline, cached for the last timeline used
+        cached = self._event_span
+        if cached is None or cached[0] is not timeline:
+            cached = (timeline, timeline.to_minute(self.start_dt), timeline.to_minute(self.end_dt, round_up=False))
+            self._event_span = cached
+        return cached[1], cached[2]
+
+    def open_at_minute(self, minute, timeline):
+        """
+        Same as open_at, for a time given in minutes on the timeline.
+        """
+        if self.type == EntityTypes.EVENT:
+            start, end = self._event_minutes(timeline)
+            return start <= minute <= end
+        return (self._hours_index or self.hours_index).open_at_minute(timeline.week_offset + minute)
+
+    def open_between_minutes(self, start, end, timeline):
+        """
+        Same as open_between, for times given in minutes on the timeline.
+        """
+        if self.type == EntityTypes.EVENT:
+            event_start, event_end = self._event_minutes(timeline)
+            return event_start <= start and end <= event_end
+        start_of_week = timeline.minute_of_week(start)
+        return (self._hours_index or self.hours_index).open_between_minutes(start_of_week, start_of_week + end - start)
 
     def get_address(self):
         if self.type == EntityTypes.BUSINESS:
@@ -84,82 +181,242 @@ class Entity:
             return ""
 
 # Todo: Maybe abstract these node/edge conditions out into a function for more flexibility
-def build_entity_graph(entities,
-                         category_sequence=None,
-                         min_distance=0,
-                         max_distance=10e10,
-                         min_rating=None,
-                         max_rating=None,
-                         min_dollar_signs=None,
-                         max_dollar_signs=None,
-                         min_review_count=None,
-                         max_review_count=None,
-                         ignore_missing_info=True):
-    g = Graph()
-    for b in entities:
+class EntityGraphBuilder:
+    """
+    Builds entity graphs (see build_entity_graph) and keeps them up to date as entities come and go. Holds the
+    node filters and edge rules, so add_entity / remove_entity apply exactly the same ones as the initial build,
+    recomputing only the edges that touch the changed entity.
+    Takes the same arguments as build_entity_graph (apart from entities and compact).
+    """
+    def __init__(self,
+                 category_sequence=None,
+                 min_distance=0,
+                 max_distance=10e10,
+                 min_rating=None,
+                 max_rating=None,
+                 min_dollar_signs=None,
+                 max_dollar_signs=None,
+                 min_review_count=None,
+                 max_review_count=None,
+                 ignore_missing_info=True,
+                 use_spatial_index=True,
+                 edge_filter=None,
+                 time_spent_fn=None,
+                 distance_time_fn=None,
+                 lazy_timing=False):
+        self.category_sequence = category_sequence
+        self.min_distance = min_distance
+        self.max_distance = max_distance
+        self.min_rating = min_rating
+        self.max_rating = max_rating
+        self.min_dollar_signs = min_dollar_signs
+        self.max_dollar_signs = max_dollar_signs
+        self.min_review_count = min_review_count
+        self.max_review_count = max_review_count
+        self.ignore_missing_info = ignore_missing_info
+        self.use_spatial_index = use_spatial_index
+        self.edge_filter = edge_filter
+        self.time_spent_fn = time_spent_fn
+        self.distance_time_fn = distance_time_fn
+        self.lazy_timing = lazy_timing
+        # For each node, which steps i of the category sequence it can start (it has a category in
+        # category_sequence[i]) and end (it has a category in category_sequence[i + 1]), as bitmasks.
+        # An edge follows the sequence if some step is in both the start node's and end node's masks.
+        self._layer_masks = [CategoryMasks(cats) for cats in category_sequence] if category_sequence is not None else []
+        self._step_masks = {}
+
+    def passes_filters(self, b):
+        """
+        True if the entity should be a node of the graph.
+        """
         if b.type == EntityTypes.BUSINESS:
             bb = b.entity
             # Ignore things with no hours
             if bb.hours is None:
-                continue
+                return False
             # Ignore rating if filter applied but it's missing
-            if min_rating is not None and max_rating is not None and bb.rating is None and ignore_missing_info:
-                continue
+            if self.min_rating is not None and self.max_rating is not None and bb.rating is None and self.ignore_missing_info:
+                return False
             # Ignore price if filter applied but it's missing
-            if(min_dollar_signs is not None or max_dollar_signs is not None) and bb.price is None and ignore_missing_info:
-                continue
+            if(self.min_dollar_signs is not None or self.max_dollar_signs is not None) and bb.price is None and self.ignore_missing_info:
+                return False
             # Ignore review count if filter applied but it's missing
-            if min_review_count is not None and bb.review_count is None and ignore_missing_info:
-                continue
+            if self.min_review_count is not None and bb.review_count is None and self.ignore_missing_info:
+                return False
 
             # Check rating
-            if (min_rating is not None and bb.rating < min_rating) or (max_rating is not None and bb.rating > max_rating):
-                continue
+            if (self.min_rating is not None and bb.rating < self.min_rating) or (self.max_rating is not None and bb.rating > self.max_rating):
+                return False
             # Check price
-            if (min_dollar_signs is not None and len(bb.price) < min_dollar_signs) or (max_dollar_signs is not None and len(bb.price) > max_dollar_signs):
-                continue
+            if (self.min_dollar_signs is not None and len(bb.price) < self.min_dollar_signs) or (self.max_dollar_signs is not None and len(bb.price) > self.max_dollar_signs):
+                return False
             # Check review count
-            if min_review_count is not None and max_review_count is not None and (bb.review_count < min_review_count or bb.review_count > max_review_count):
-                continue
+            if self.min_review_count is not None and self.max_review_count is not None and (bb.review_count < self.min_review_count or bb.review_count > self.max_review_count):
+                return False
         else:
             # Event conditions go here (if I decide to add those... may be better to roll them into constraints
             # that are applied now at graph creation time so all constraints defined in same way.
             pass
+        return True
 
-        # Add if all conditions passed
-        g.add_node(b)
+    def _get_step_masks(self, node):
+        masks = self._step_masks.get(node)
+        if masks is None:
+            layer_masks = self._layer_masks
+            starts, ends = 0, 0
+            for i in range(len(layer_masks) - 1):
+                if node.category_mask & layer_masks[i][node.category_index]:
+                    starts |= 1 << i
+                if node.category_mask & layer_masks[i + 1][node.category_index]:
+                    ends |= 1 << i
+            masks = (starts, ends)
+            self._step_masks[node] = masks
+        return masks
 
-    valid_seqs = set()
-    # Generate all possible sequences of categories for faster lookup
-    if category_sequence is not None:
-        for i in range(len(category_sequence) - 1):
-            for j in range(len(category_sequence[i])):
-                for k in range(len(category_sequence[i + 1])):
-                    valid_seqs.add((category_sequence[i][j], category_sequence[i + 1][k]))
-
-    def is_valid_edge(bizA, bizB):
-        bizA = bizA.entity
-        bizB = bizB.entity
+    def is_valid_edge(self, bizA, bizB, dist):
         # Distance check
-        dist = lat_long_dist(bizA.latitude, bizA.longitude, bizB.latitude, bizB.longitude)
-        if dist > max_distance or dist < min_distance:
+        if dist > self.max_distance or dist < self.min_distance:
+            return False
+        # Constraint checks moved to graph build time
+        if self.edge_filter is not None and not self.edge_filter(bizA, bizB, {"dist": dist}):
             return False
 
         # Category check
-        categories_valid = False
-        for catA in bizA.categories:
-            for catB in bizB.categories:
-                        if (catA, catB) in valid_seqs or category_sequence is None:
-                            return True
-        return categories_valid
+        if self.category_sequence is None:
+            return True
+        return (self._get_step_masks(bizA)[0] & self._get_step_masks(bizB)[1]) != 0
 
-    def edge_properties(bizA, bizB):
-        bizA, bizB = bizA.entity, bizB.entity
-        return {"dist": lat_long_dist(bizA.latitude, bizA.longitude, bizB.latitude, bizB.longitude)}
+    def edge_properties(self, bizA, bizB, dist):
+        return {"dist": dist}
 
-    g.auto_build_edges(is_valid_edge, edge_properties)
+    def build(self, entities, compact=False):
+        g = Graph()
+        for b in entities:
+            # Add if all conditions passed
+            if self.passes_filters(b):
+                g.add_node(b)
 
-    return g
+        # Compute the distances for all pairs within range at once
+        nodes = list(g.nodes)
+        rows, cols, dists = lat_long_dist_within([n.entity.latitude for n in nodes],
+                                                  [n.entity.longitude for n in nodes],
+                                                  self.max_distance,
+                                                  min_distance=self.min_distance,
+                                                  use_grid=self.use_spatial_index)
+        if compact:
+            keep = [self.is_valid_edge(nodes[i], nodes[j], dist) for i, j, dist in zip(rows.tolist(), cols.tolist(), dists.tolist())]
+            keep = np.asarray(keep, dtype=bool)
+            g = CSRGraph.from_edges(nodes, rows[keep], cols[keep], {"dist": dists[keep]})
+        else:
+            for i, j, dist in zip(rows.tolist(), cols.tolist(), dists.tolist()):
+                nodeA, nodeB = nodes[i], nodes[j]
+                if self.is_valid_edge(nodeA, nodeB, dist):
+                    g.add_edge(nodeA, nodeB, self.edge_properties(nodeA, nodeB, dist))
+
+        if self.time_spent_fn is not None or self.distance_time_fn is not None:
+            g.timing = TimingTable(g,
+                                   self.time_spent_fn if self.time_spent_fn is not None else default_time_spent_fn,
+                                   self.distance_time_fn if self.distance_time_fn is not None else default_distance_time_fn,
+                                   lazy=self.lazy_timing)
+        return g
+
+    def add_entity(self, graph, entity):
+        """
+        Adds the entity to a Graph built by this builder, along with its edges to and from the nodes already
+        there. Only distances from the new entity are computed.
+        :return: True if it was added, False if it didn't pass the filters (or is already in the graph).
+        """
+        if not isinstance(graph, Graph):
+            raise TypeError("Only Graphs can be updated, not compact CSRGraphs")
+        if entity in graph.nodes or not self.passes_filters(entity):
+            return False
+        others = list(graph.nodes)
+        graph.add_node(entity)
+        changed = [entity]
+        if len(others) > 0:
+            dists = lat_long_dist_to_many(entity.entity.latitude, entity.entity.longitude,
+                                          [n.entity.latitude for n in others],
+                                          [n.entity.longitude for n in others])
+            in_range = np.nonzero((dists <= self.max_distance) & (dists >= self.min_distance))[0]
+            for i, dist in zip(in_range.tolist(), dists[in_range].tolist()):
+                other = others[i]
+                if self.is_valid_edge(entity, other, dist):
+                    graph.add_edge(entity, other, self.edge_properties(entity, other, dist))
+                if self.is_valid_edge(other, entity, dist):
+                    graph.add_edge(other, entity, self.edge_properties(other, entity, dist))
+                    changed.append(other)
+        graph.invalidate_timing(changed)
+        return True
+
+    def remove_entity(self, graph, entity):
+        """
+        Removes the entity and every edge to or from it from a Graph built by this builder.
+        :return: True if it was in the graph.
+        """
+        if not isinstance(graph, Graph):
+            raise TypeError("Only Graphs can be updated, not compact CSRGraphs")
+        if entity not in graph.nodes:
+            return False
+        predecessors = graph.get_predecessors(entity)
+        graph.remove_node(entity)
+        self._step_masks.pop(entity, None)
+        graph.invalidate_timing([entity] + list(predecessors))
+        return True
+
+
+def build_entity_graph(entities,
+                         category_sequence=None,
+                         min_distance=0,
+                         max_distance=10e10,
+                         min_rating=None,
+                         max_rating=None,
+                         min_dollar_signs=None,
+                         max_dollar_signs=None,
+                         min_review_count=None,
+                         max_review_count=None,
+                         ignore_missing_info=True,
+                         use_spatial_index=True,
+                         compact=False,
+                         edge_filter=None,
+                         time_spent_fn=None,
+                         distance_time_fn=None,
+                         lazy_timing=False):
+    """
+    Builds a graph over the entities that pass the given filters, with an edge between every
+    pair of entities that are between min_distance and max_distance apart and follow the
+    category sequence (if given).
+    :param use_spatial_index: If True, bucket entities into a lat/long grid so only pairs that
+                              could be within max_distance are checked. Produces the same edges
+                              as checking all pairs. Distances are computed in batches either way.
+    :param compact: If True, return a read-only CSRGraph instead of a Graph.
+    :param edge_filter: Optional fn(nodeA, nodeB, edge_properties) that must be True for an edge to be added, such
+                        as the checks constraint_expr.edge_filter pulls out of a constraint expression.
+    :param time_spent_fn: If this or distance_time_fn is given, the graph gets a TimingTable (graph.timing) of
+                          dwell options and per-edge travel times, which searches then read instead of calling
+                          the functions for every state. Missing functions use the defaults. The table keeps
+                          the functions, so to pickle the graph (e.g. for plan.generate_plans_parallel) they
+                          have to be module level, not lambdas or closures.
+    :param distance_time_fn: See time_spent_fn.
+    :param lazy_timing: If True, fill in the TimingTable a node at a time as the search reaches it rather than
+                        for the whole graph up front.
+    To keep a graph up to date as entities are added or removed, build it with an EntityGraphBuilder instead.
+    """
+    builder = EntityGraphBuilder(category_sequence=category_sequence,
+                                 min_distance=min_distance,
+                                 max_distance=max_distance,
+                                 min_rating=min_rating,
+                                 max_rating=max_rating,
+                                 min_dollar_signs=min_dollar_signs,
+                                 max_dollar_signs=max_dollar_signs,
+                                 min_review_count=min_review_count,
+                                 max_review_count=max_review_count,
+                                 ignore_missing_info=ignore_missing_info,
+                                 use_spatial_index=use_spatial_index,
+                                 edge_filter=edge_filter,
+                                 time_spent_fn=time_spent_fn,
+                                 distance_time_fn=distance_time_fn,
+                                 lazy_timing=lazy_timing)
+    return builder.build(entities, compact=compact)
 
 
 def default_time_spent_fn(entity):
@@ -170,66 +427,172 @@ def default_distance_time_fn(dist):
     avg_walk_speed = 1.4 # m/s
     return datetime.timedelta(seconds=dist/avg_walk_speed)
 
-def build_neighbor_state_fn(constraint, time_spent_fn=default_time_spent_fn, distance_time_fn=default_distance_time_fn):
+def get_timing_table(graph, time_spent_fn=None, distance_time_fn=None):
+    """
+    Returns the graph's TimingTable if it was built with the same functions, otherwise a lazy one for these
+    functions. Functions that are None fall back to the graph's (or the defaults if it has no TimingTable).
+    Lazy tables are kept in graph.timing_tables, so searches with the same functions share one and
+    EntityGraphBuilder.add_entity / remove_entity keep it up to date.
+    """
+    timing = graph.timing
+    if timing is not None:
+        time_spent_fn = time_spent_fn if time_spent_fn is not None else timing.time_spent_fn
+        distance_time_fn = distance_time_fn if distance_time_fn is not None else timing.distance_time_fn
+        if timing.matches(time_spent_fn, distance_time_fn):
+            return timing
+    time_spent_fn = time_spent_fn if time_spent_fn is not None else default_time_spent_fn
+    distance_time_fn = distance_time_fn if distance_time_fn is not None else default_distance_time_fn
+    key = (time_spent_fn, distance_time_fn)
+    timing = graph.timing_tables.get(key)
+    if timing is None:
+        timing = TimingTable(graph, time_spent_fn, distance_time_fn, lazy=True)
+        graph.timing_tables[key] = timing
+    return timing
+
+
+def open_visits(out_edges, departure, timing, timeline, require_open_throughout=False, stats=None):
+    """
+    Yields (node, start, end) for every visit reachable by leaving at minute departure along out_edges, one per
+    dwell option of each node, during which the place is open: when arriving and leaving, or for the whole visit
+    with require_open_throughout. This is the expansion step shared by build_neighbor_state_fn,
+    build_initial_states and layered.LayeredSearch.
+    :param out_edges: (node, travel minutes) pairs, e.g. TimingTable.out_edges.
+    :param timing: The TimingTable to read dwell options from.
+    :param stats: Optional stats.SearchStats to count the visits yielded (candidates) and rejected for opening
+                  hours in and time the opening hours checks into.
+    """
+    if stats is None:
+        for node, travel_time in out_edges:
+            start = departure + travel_time
+            # Only explore things that are open at desired start time
+            if node.open_at_minute(start, timeline):
+                # Try all possible amounts of time to stay there, making sure it's open
+                for time_spent in timing.dwell_options(node):
+                    end = start + time_spent
+                    if (node.open_between_minutes(start, end, timeline) if require_open_throughout
+                            else node.open_at_minute(end, timeline)):
+                        yield node, start, end
+        return
+
+    timer = time.perf_counter
+    for node, travel_time in out_edges:
+        start = departure + travel_time
+        check_start = timer()
+        is_open = node.open_at_minute(start, timeline)
+        stats.open_hours_seconds += timer() - check_start
+        if not is_open:
+            stats.rejected_closed_on_arrival += 1
+            continue
+        for time_spent in timing.dwell_options(node):
+            end = start + time_spent
+            check_start = timer()
+            is_open = (node.open_between_minutes(start, end, timeline) if require_open_throughout
+                       else node.open_at_minute(end, timeline))
+            stats.open_hours_seconds += timer() - check_start
+            if not is_open:
+                stats.rejected_closed_on_departure += 1
+                continue
+            stats.candidates += 1
+            yield node, start, end
+
+
+def build_neighbor_state_fn(constraint,
+                            time_spent_fn=None,
+                            distance_time_fn=None,
+                            require_open_throughout=False,
+                            stats=None):
     """
     Returns a function that returns all the valid neighbors of given state.
+    Travel and dwell times come from the graph's TimingTable (see build_entity_graph and get_timing_table), so
+    each is only computed once per edge / node.
     :param constraint: The constraint that determines whether something is a valid neighbor or not.
     :param time_spent_fn: A function which returns how much time could be spent somewhere given an Entity as a list
-                          of timedeltas.
-    :param distance_time_fn: A function that converts distance (meters) to travel time (timedelta)
+                          of timedeltas. Defaults to the graph's, or default_time_spent_fn.
+    :param distance_time_fn: A function that converts distance (meters) to travel time (timedelta). Defaults to
+                             the graph's, or default_distance_time_fn.
+    :param require_open_throughout: If True, a place must be open for the whole visit rather than just when
+                                    arriving and leaving.
+    :param stats: Optional stats.SearchStats to count candidates, opening hours and constraint rejections in and
+                  time the function.
     :return:
     """
+    # TimingTable for the graph last searched
+    timing_cache = [None]
+    timer = time.perf_counter
+
     def neighbor_state_fn(constraint_params):
+        if stats is not None:
+            call_start = timer()
         graph, curr_state, global_memory = constraint_params.graph, constraint_params.curr_state, constraint_params.global_memory
+        timing = timing_cache[0]
+        if timing is None or timing.graph is not graph:
+            timing = get_timing_table(graph, time_spent_fn, distance_time_fn)
+            timing_cache[0] = timing
+        timeline = curr_state.timeline
         neighbors = []
         num_prev_states = curr_state.num_prev_states + 1
-        potential_neighbors = graph.get_edges(curr_state.node)
-        #print("\t\tFound {} potential neighbors".format(len(potential_neighbors)))
-        for node in potential_neighbors:
-            properties = graph.get_edge_properties(curr_state.node, node)
-            dist = properties['dist']
-
-            # Only explore things that are open at desired start time
-            next_start_dt = curr_state.end_dt + distance_time_fn(dist)
-            if node.open_at(next_start_dt):
-                # Try all possible amounts of time to stay at next spot
-                possible_times_spent_next = time_spent_fn(node)
-                for time_spent_next in possible_times_spent_next:
-                    next_end_dt = next_start_dt + time_spent_next
-                    # Make sure it's open
-                    if node.open_at(next_end_dt):
-                        next_state = PlanState(node, next_start_dt, next_end_dt, curr_state, num_prev_states)
-                        constraint_params = ConstraintParams(graph, curr_state, next_state, global_memory)
-                        if constraint(constraint_params):
-                            neighbors.append(next_state)
+        for node, next_start, next_end in open_visits(timing.out_edges(curr_state.node), curr_state.end, timing,
+                                                      timeline, require_open_throughout, stats):
+            next_state = PlanState(node, next_start, next_end, curr_state, num_prev_states, timeline)
+            if constraint(ConstraintParams(graph, curr_state, next_state, global_memory)):
+                neighbors.append(next_state)
+            elif stats is not None:
+                stats.rejected_by_constraint += 1
 
+        if stats is not None:
+            stats.neighbors_generated += len(neighbors)
+            stats.neighbor_seconds += timer() - call_start
         return neighbors
+
     return neighbor_state_fn
 
 
-def build_initial_states(graph, possible_start_dts, constraint, time_spent_fn=default_time_spent_fn):
+def build_initial_states(graph, possible_start_dts, constraint, time_spent_fn=None,
+                         require_open_throughout=False, timeline=None):
     """
     Returns a list of valid starting states according to the constraint.
     :param graph: The graph whose states will be returned.
     :param possible_start_dts: The possible start times.
     :param constraint: The constraint on initial states (passed as the "current state" to constraints)
-    :param time_spent_fn: A function that returns a list of possible times spent given an Entity.
+    :param time_spent_fn: A function that returns a list of possible times spent given an Entity. Defaults to the
+                          graph's TimingTable, or default_time_spent_fn.
+    :param require_open_throughout: If True, a place must be open for the whole visit rather than just when
+                                    arriving and leaving.
+    :param timeline: The Timeline to schedule the plans on. Defaults to one starting on the day of the earliest
+                     start time. Start times are rounded up to whole minutes.
     :return:
     """
+    if len(possible_start_dts) == 0:
+        return []
+    if timeline is None:
+        timeline = Timeline(min(possible_start_dts))
+    possible_starts = [timeline.to_minute(start_dt) for start_dt in possible_start_dts]
+    timing = get_timing_table(graph, time_spent_fn=time_spent_fn)
     initial_states = []
     for node in graph.nodes:
-        possible_times_spent = time_spent_fn(node)
-        for start_dt in possible_start_dts:
-            if node.open_at(start_dt):
-                for time_spent in possible_times_spent:
-                    end_dt = start_dt + time_spent
-                    if node.open_at(end_dt):
-                        initial_state = PlanState(node, start_dt, end_dt, None, 0)
-                        constraint_params = ConstraintParams(graph, initial_state, None, None)
-                        if constraint(constraint_params):
-                            initial_states.append(initial_state)
+        # Starting somewhere is arriving there after no travel
+        here = ((node, 0),)
+        for possible_start in possible_starts:
+            for _, start, end in open_visits(here, possible_start, timing, timeline, require_open_throughout):
+                initial_state = PlanState(node, start, end, None, 0, timeline)
+                constraint_params = ConstraintParams(graph, initial_state, None, None)
+                if constraint(constraint_params):
+                    initial_states.append(initial_state)
     return initial_states
 
+def build_state_key_fn(attr_names=("num_prev_states", "visited_ids")):
+    """
+    Returns fn(state) giving a key for merging equivalent states in generate_plans. Two states get the same key
+    when they're at the same node, end at the same time and agree on each of the given PlanState attributes, so
+    list everything the constraints read about a state besides its node and end time (the defaults cover
+    sequence position and no_repeat_visits). constraint_expr.state_key_fn works this out for expressions.
+    """
+    attr_names = tuple(sorted(set(attr_names) - {"node", "end", "end_dt"}))
+    def state_key_fn(state):
+        return (state.node, state.end) + tuple(getattr(state, name) for name in attr_names)
+    return state_key_fn
+
+
 def build_success_state_fn(constraint):
     """
     A function that returns True if the current state is a success state, and False otherwise.
@@ -0,0 +1,223 @@
+import asyncio
+import datetime
+
+import aiohttp
+
+from categories import DEFAULT_TAXONOMY_CACHE_DIR
+from .yelp import YelpAPI
+
+
+def _encode_params(params):
+    # aiohttp only takes strings and numbers, so encode the way requests does
+    # (lists become repeated keys, everything else is str()'d).
+    encoded = []
+    for k, v in params.items():
+        values = v if isinstance(v, (list, tuple, set)) else [v]
+        for value in values:
+            encoded.append((k, value if isinstance(value, (str, int, float)) and not isinstance(value, bool) else str(value)))
+    return encoded
+
+
+class AsyncYelpAPI(YelpAPI):
+    """
+    asyncio version of YelpAPI. Requests share one pooled HTTP session and at most max_concurrency run at
+    once. Returns the same BusinessSearchResult / EventSearchResult objects as YelpAPI.
+    Use it as an async context manager (or call close()) so the session gets cleaned up:
+
+        async with AsyncYelpAPI(apikey, categories_file) as api:
+            results = await api.business_search(location="New York", categories=["bars"])
+    """
+    def __init__(self, apikey, categories_file, api_host=r"https://api.yelp.com/v3/", cache=None,
+                 category_index=None, max_concurrency=10, session=None, taxonomy_cache_dir=DEFAULT_TAXONOMY_CACHE_DIR):
+        super().__init__(apikey, categories_file, api_host=api_host, cache=cache, category_index=category_index,
+                         taxonomy_cache_dir=taxonomy_cache_dir)
+        self.max_concurrency = max_concurrency
+        self._session = session
+        self._owns_session = session is None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None and self._owns_session:
+            await self._session.close()
+        self._session = None
+
+    def _get_session(self):
+        # Created on first use so it belongs to the running event loop
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+            self._owns_session = True
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    async def _request(self, endpoint, url_params):
+        resp = self._cache_get(endpoint, url_params)
+        if resp is None:
+            session = self._get_session()
+            url = "{0}{1}".format(self.API_HOST, endpoint)
+            async with self._semaphore:
+                async with session.get(url, headers=self._request_headers(), params=_encode_params(url_params)) as response:
+                    resp = await response.json(content_type=None)
+            self._cache_set(endpoint, url_params, resp)
+        return resp
+
+    async def _graphql_request(self, query):
+        return self._unwrap_graphql_response(await self._graphql_request_raw(query))
+
+    async def _graphql_request_raw(self, query):
+        resp = self._cache_get("graphql", {"query": query})
+        if resp is None:
+            session = self._get_session()
+            url = "{0}graphql".format(self.API_HOST)
+            async with self._semaphore:
+                async with session.post(url, headers=self._graphql_request_headers(), data=query) as response:
+                    resp = await response.json(content_type=None)
+            self._cache_set("graphql", {"query": query}, resp)
+        return resp
+
+    async def business_search(self,
+                              term=None,
+                              location=None,
+                              latitude=None,
+                              longitude=None,
+                              radius=None,
+                              categories=None,
+                              locale=None,
+                              limit=20,
+                              offset=0,
+                              sort_by=None,
+                              price=None,
+                              open_now=None,
+                              open_at=None,
+                              attributes=None,
+                              add_parent_categories=False,
+                              max_num_businesses=20):
+        params = dict(locals())
+        del params['self']
+        result = None
+        async for page in self._business_search_pages(params):
+            if result is None:
+                result = page
+            else:
+                result['businesses'].extend(page['businesses'])
+        return result
+
+    async def iter_business_search(self,
+                                   term=None,
+                                   location=None,
+                                   latitude=None,
+                                   longitude=None,
+                                   radius=None,
+                                   categories=None,
+                                   locale=None,
+                                   limit=20,
+                                   offset=0,
+                                   sort_by=None,
+                                   price=None,
+                                   open_now=None,
+                                   open_at=None,
+                                   attributes=None,
+                                   add_parent_categories=False,
+                                   max_num_businesses=20):
+        """
+        Same as business_search, but yields the businesses a page at a time (in order) as they arrive.
+        Once the first page says how many results there are, the rest are fetched concurrently.
+        """
+        params = dict(locals())
+        del params['self']
+        async for page in self._business_search_pages(params):
+            yield page['businesses']
+
+    async def _business_search_pages(self, search_args):
+        search_args = dict(search_args)
+        search_args['limit'] = min(search_args['max_num_businesses'], search_args['limit'])
+        first_page = await self._business_search_page(search_args)
+        yield first_page
+
+        tasks = [asyncio.ensure_future(self._business_search_page(page_args))
+                 for page_args in self._remaining_business_search_pages(search_args, first_page)]
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            # Don't fetch pages nobody is going to read
+            for task in tasks:
+                task.cancel()
+
+    async def _business_search_page(self, search_args):
+        response = await self._request("businesses/search", self._business_search_params(search_args))
+        return self._process_business_search_response(response, search_args['add_parent_categories'])
+
+    async def business_details(self, id, add_parent_categories=False):
+        result = await self._request("businesses/{0}".format(id), {})
+        return self._process_business_detail(result, add_parent_categories)
+
+    async def graphql_bulk_business_hours(self, ids):
+        resp = await self._graphql_request_raw(self._bulk_business_hours_query(ids))
+        if resp.get('data') is None:
+            raise Exception("Hours query failed: {}".format(resp.get('errors', resp)))
+        hours = self._process_bulk_business_hours_response(ids, resp)
+        return [hours[biz_id] for biz_id in ids]
+
+    async def bulk_business_hours(self, ids, max_query_cost=None):
+        """
+        Same as YelpAPI.bulk_business_hours. Batches run concurrently, up to max_concurrency at a time.
+        """
+        if max_query_cost is None:
+            max_query_cost = self.HOURS_QUERY_MAX_COST
+        to_fetch = [biz_id for biz_id in dict.fromkeys(ids) if biz_id not in self.known_hours]
+        batch_size = max(1, max_query_cost // self.HOURS_QUERY_COST_PER_BUSINESS)
+        fetched = await asyncio.gather(*[self._fetch_hours_batch(to_fetch[i:i + batch_size])
+                                         for i in range(0, len(to_fetch), batch_size)])
+        hours = {}
+        for batch_hours in fetched:
+            hours.update(batch_hours)
+        return {biz_id: hours.get(biz_id, self.known_hours.get(biz_id)) for biz_id in ids}
+
+    async def _fetch_hours_batch(self, ids):
+        try:
+            resp = await self._graphql_request_raw(self._bulk_business_hours_query(ids))
+        except (aiohttp.ClientError, ValueError):
+            resp = {}
+        if resp.get('data') is None:
+            # The whole query failed (e.g. it was too expensive), so try again in smaller pieces
+            if len(ids) == 1:
+                return {ids[0]: None}
+            mid = len(ids) // 2
+            first, second = await asyncio.gather(self._fetch_hours_batch(ids[:mid]), self._fetch_hours_batch(ids[mid:]))
+            first.update(second)
+            return first
+        return self._process_bulk_business_hours_response(ids, resp)
+
+    async def add_hours_to_search_results(self, results, max_query_cost=None):
+        missing = [r for r in results if r.hours is None]
+        hours = await self.bulk_business_hours([r.id for r in missing], max_query_cost)
+        for r in missing:
+            r.hours = hours[r.id]
+
+    async def event_search(self,
+                           offset=None,
+                           limit=None,
+                           sort_by=None,
+                           sort_on=None,
+                           start_date=None, # Datetime object
+                           end_date=None, # Datetime object
+                           categories=None,
+                           is_free=None,
+                           location=None,
+                           latitude=None,
+                           longitude=None,
+                           radius=None,
+                           excluded_events=None,
+                           timezone=None,
+                           duration_if_no_end=datetime.timedelta(seconds=3600 * 2)): # Default duration 2hrs if no end time
+        params = dict(locals())
+        del params['self']
+        response = await self._request("events", self._event_search_params(params))
+        return self._process_event_search_response(response, timezone, duration_if_no_end)
@@ -0,0 +1,129 @@
+import json
+import sqlite3
+import threading
+import time
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class ResponseCache:
+    """
+    SQLite backed cache of raw Yelp API responses, keyed on the endpoint plus normalized request parameters.
+    Entries expire after a per-endpoint TTL, and once there are more than max_entries the least recently used
+    ones are evicted. Safe to share between threads.
+    """
+    # Longest matching endpoint prefix wins. GraphQL is only used for hours, which rarely change.
+    DEFAULT_TTLS = {
+        "businesses/search": DAY,
+        "businesses/": 7 * DAY,
+        "events": HOUR,
+        "graphql": 7 * DAY,
+    }
+
+    def __init__(self, path=":memory:", ttls=None, default_ttl=DAY, max_entries=10000):
+        """
+        :param path: SQLite database file. Defaults to an in-memory cache.
+        :param ttls: Dict mapping endpoint prefix to TTL in seconds. Overrides DEFAULT_TTLS.
+        :param default_ttl: TTL in seconds for endpoints with no matching prefix.
+        :param max_entries: Maximum number of responses to keep.
+        """
+        self.ttls = dict(self.DEFAULT_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires REAL NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._conn.commit()
+        self._num_entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def ttl(self, endpoint):
+        best = None
+        for prefix in self.ttls:
+            if endpoint.startswith(prefix) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return self.ttls[best] if best is not None else self.default_ttl
+
+    def make_key(self, endpoint, params):
+        # Drop missing values and encode everything the way it goes over the wire, so equivalent requests
+        # share an entry regardless of argument order or types.
+        normalized = {}
+        for k, v in params.items():
+            if v is None:
+                continue
+            if isinstance(v, (list, tuple)):
+                normalized[k] = [str(x) for x in v]
+            else:
+                normalized[k] = str(v)
+        return "{0}?{1}".format(endpoint, json.dumps(normalized, sort_keys=True))
+
+    def get(self, endpoint, params):
+        """
+        Returns the cached response, or None if it's missing or expired.
+        """
+        key = self.make_key(endpoint, params)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] < now:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._num_entries -= 1
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, endpoint, params, value):
+        key = self.make_key(endpoint, params)
+        now = time.time()
+        with self._lock:
+            existed = self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, endpoint, value, expires, last_access) "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               (key, endpoint, json.dumps(value), now + self.ttl(endpoint), now))
+            if not existed:
+                self._num_entries += 1
+            if self._num_entries > self.max_entries:
+                num_evict = self._num_entries - self.max_entries
+                self._conn.execute("DELETE FROM responses WHERE key IN "
+                                   "(SELECT key FROM responses ORDER BY last_access LIMIT ?)", (num_evict,))
+                self._num_entries -= num_evict
+                self.evictions += num_evict
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._num_entries = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "evictions": self.evictions,
+            "entries": self._num_entries,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,9 +1,11 @@
-import json
-import requests
 import datetime
 import time
-import dateutil.parser
-import pytz
+from concurrent.futures import ThreadPoolExecutor
+
+from categories import DEFAULT_TAXONOMY_CACHE_DIR, default_category_index, load_compiled_taxonomy
+
+# requests, dateutil and pytz are imported where they're used, so importing this module (e.g. just to build
+# entities) stays fast.
 
 # YELP TIMEZONE BUG:
 # All events are assumed to originally have been in Pacific time.
@@ -11,6 +13,8 @@ import pytz
 # and then convert that to UTC.
 # When getting results from Yelp, convert from UTC to Pacific time, then set the Timezone to the local time (without changing time)
 def str_to_datetime(date_string, timezone_name):
+    import dateutil.parser
+    import pytz
     dt = dateutil.parser.parse(date_string)
     return pytz.timezone(timezone_name).localize(dt)
 
@@ -20,6 +24,7 @@ def str_to_unix(date_string, timezone_name):
     return int(dt.timestamp())
 
 def to_local_time(dt, timezone_name):
+    import pytz
     # Convert from UTC to PDT
     dt = dt.astimezone(pytz.timezone("America/Los_Angeles"))
     # Set timezone to actual timezone instead of PDT and remove timezone info.
@@ -150,10 +155,31 @@ class EventSearchResult():
 
 
 class YelpAPI():
-    def __init__(self, apikey, categories_file):
-        self.API_HOST = r"https://api.yelp.com/v3/"
+    # Yelp won't return business search results past this offset
+    MAX_SEARCH_RESULTS = 1000
+    # Rough GraphQL cost of looking up one business's hours (fields requested), and the most to put in one query
+    HOURS_QUERY_COST_PER_BUSINESS = 10
+    HOURS_QUERY_MAX_COST = 200
+
+    def __init__(self, apikey, categories_file, api_host=r"https://api.yelp.com/v3/", cache=None,
+                 category_index=None, taxonomy_cache_dir=DEFAULT_TAXONOMY_CACHE_DIR):
+        """
+        :param cache: Optional ResponseCache (see cache.py) to serve repeated requests from.
+        :param category_index: CategoryIndex to load the category hierarchy into. Defaults to the one entities use.
+        :param taxonomy_cache_dir: Where to cache the compiled categories file (see load_compiled_taxonomy).
+                                   None to always parse the JSON.
+        """
+        self.API_HOST = api_host
+        self.cache = cache
+        # Business id -> hours for every business whose hours have been looked up
+        self.known_hours = {}
         self.API_KEY = apikey
-        self.BIZ_CATEGORIES = self._read_categories(categories_file)
+        # The taxonomy is loaded on first use, see BIZ_CATEGORIES and add_parent_categories
+        self.categories_file = categories_file
+        self.taxonomy_cache_dir = taxonomy_cache_dir
+        self._biz_categories = None
+        self._compiled_categories = None
+        self.category_index = category_index if category_index is not None else default_category_index()
         self.EVENT_CATEGORIES = {
             "music": {"title": "Music", "parents": []},
             "visual-arts": {"title": "Visual Arts", "parents": []},
@@ -170,31 +196,65 @@ class YelpAPI():
             "other": {"title": "Other", "parents": []}
         }
 
-    def _read_categories(self, categories_file):
-        with open(categories_file, "r") as f:
-            cats = json.load(f)
-        categories = {}
-        for elem in cats:
-            categories[elem['alias']] = {"title": elem['title'], "parents": elem['parents']}
-        return categories
+    @property
+    def BIZ_CATEGORIES(self):
+        if self._biz_categories is None:
+            self._biz_categories = self._compiled_taxonomy().to_taxonomy()
+        return self._biz_categories
 
-    def _request(self, endpoint, url_params):
-        headers = {
+    def _compiled_taxonomy(self):
+        if self._compiled_categories is None:
+            self._compiled_categories = load_compiled_taxonomy(self.categories_file, self.taxonomy_cache_dir)
+            self.category_index.add_compiled(self._compiled_categories)
+        return self._compiled_categories
+
+    def _request_headers(self):
+        return {
             "Authorization": "Bearer {0}".format(self.API_KEY)
         }
-        url = "{0}{1}".format(self.API_HOST, endpoint)
-        response = requests.request('GET', url, headers=headers, params=url_params)
-        return response.json()
 
-    def _graphql_request(self, query):
-        headers = {
+    def _graphql_request_headers(self):
+        return {
             "Authorization": "Bearer {0}".format(self.API_KEY),
             "Content-Type": "application/graphql",
             "Accept-Language": "en_US"
         }
-        url = "{0}graphql".format(self.API_HOST)
-        response = requests.request('POST', url, headers=headers, data=query)
-        resp = response.json()
+
+    def _request(self, endpoint, url_params):
+        resp = self._cache_get(endpoint, url_params)
+        if resp is None:
+            import requests
+            url = "{0}{1}".format(self.API_HOST, endpoint)
+            response = requests.request('GET', url, headers=self._request_headers(), params=url_params)
+            resp = response.json()
+            self._cache_set(endpoint, url_params, resp)
+        return resp
+
+    def _graphql_request(self, query):
+        return self._unwrap_graphql_response(self._graphql_request_raw(query))
+
+    def _graphql_request_raw(self, query):
+        # Returns the whole response, including any "errors"
+        resp = self._cache_get("graphql", {"query": query})
+        if resp is None:
+            import requests
+            url = "{0}graphql".format(self.API_HOST)
+            response = requests.request('POST', url, headers=self._graphql_request_headers(), data=query)
+            resp = response.json()
+            self._cache_set("graphql", {"query": query}, resp)
+        return resp
+
+    def _cache_get(self, endpoint, params):
+        if self.cache is None:
+            return None
+        return self.cache.get(endpoint, params)
+
+    def _cache_set(self, endpoint, params, resp):
+        # Don't cache failures (including partial GraphQL failures)
+        if self.cache is not None and 'error' not in resp and 'errors' not in resp:
+            self.cache.set(endpoint, params, resp)
+
+    def _unwrap_graphql_response(self, resp):
         if 'data' in resp:
             return resp['data']
         else:
@@ -204,19 +264,8 @@ class YelpAPI():
         return set([cat['alias'] for cat in categories]) if categories is not None else None
 
     def add_parent_categories(self, categories):
-        if categories is None:
-            return None
-        enhanced_categories = set()
-        queue = []
-        queue.extend(categories)
-        while(len(queue) > 0):
-            cat = queue.pop()
-            if cat not in enhanced_categories:
-                if cat in self.BIZ_CATEGORIES:
-                    parents = self.BIZ_CATEGORIES[cat]['parents']
-                    queue.extend(parents)
-                enhanced_categories.add(cat)
-        return enhanced_categories
+        self._compiled_taxonomy()
+        return self.category_index.expand(categories)
 
     # https://www.yelp.com/developers/documentation/v3/business_search
     # Fusion endpoint. Doesn't return hours.
@@ -236,48 +285,97 @@ class YelpAPI():
                         open_at=None,
                         attributes=None,
                         add_parent_categories=False,
-                        max_num_businesses=20):
-        limit = min(max_num_businesses, limit)
+                        max_num_businesses=20,
+                        max_concurrency=4):
         params = dict(locals())
+        del params['self']
+        del params['max_concurrency']
+        result = None
+        for page in self._business_search_pages(params, max_concurrency):
+            if result is None:
+                result = page
+            else:
+                result['businesses'].extend(page['businesses'])
+        return result
+
+    def iter_business_search(self,
+                             term=None,
+                             location=None,
+                             latitude=None,
+                             longitude=None,
+                             radius=None,
+                             categories=None,
+                             locale=None,
+                             limit=20,
+                             offset=0,
+                             sort_by=None,
+                             price=None,
+                             open_now=None,
+                             open_at=None,
+                             attributes=None,
+                             add_parent_categories=False,
+                             max_num_businesses=20,
+                             max_concurrency=4):
+        """
+        Same as business_search, but yields the businesses a page at a time (in order) as they arrive.
+        Once the first page says how many results there are, the rest are fetched concurrently.
+        """
+        params = dict(locals())
+        del params['self']
+        del params['max_concurrency']
+        for page in self._business_search_pages(params, max_concurrency):
+            yield page['businesses']
+
+    def _business_search_pages(self, search_args, max_concurrency):
+        search_args = dict(search_args)
+        search_args['limit'] = min(search_args['max_num_businesses'], search_args['limit'])
+        first_page = self._business_search_page(search_args)
+        yield first_page
+
+        remaining_page_args = self._remaining_business_search_pages(search_args, first_page)
+        if len(remaining_page_args) == 0:
+            return
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        try:
+            futures = [executor.submit(self._business_search_page, page_args) for page_args in remaining_page_args]
+            for future in futures:
+                yield future.result()
+        finally:
+            # Don't fetch pages nobody is going to read
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _business_search_page(self, search_args):
+        response = self._request("businesses/search", self._business_search_params(search_args))
+        return self._process_business_search_response(response, search_args['add_parent_categories'])
+
+    def _remaining_business_search_pages(self, search_args, first_page):
+        # Returns the arguments for every page after the first one
+        limit = search_args['limit']
+        num_found = len(first_page['businesses'])
+        if num_found < limit:
+            return []
+        end = min(search_args['max_num_businesses'], first_page['total'], self.MAX_SEARCH_RESULTS)
+        return [dict(search_args, offset=offset, limit=min(limit, end - offset))
+                for offset in range(search_args['offset'] + num_found, end, limit)]
+
+    def _business_search_params(self, search_args):
+        # Turn business_search's arguments into request parameters
+        params = dict(search_args)
         del params['add_parent_categories']
         del params['max_num_businesses']
-        del params['self']
         keys = list(params.keys())
         for k in keys:
             if params[k] is None:
                 del params[k]
-        response = self._request("businesses/search", params)
-        businesses = response['businesses']
-        business_objs = self._process_business_search_businesses(businesses, add_parent_categories)
-
-        num_businesses_left = max_num_businesses - len(business_objs) - offset
-        if num_businesses_left > 0 and len(business_objs) == limit:
-            print(num_businesses_left, "businesses left. Found", len(business_objs)," just now.")
-            additional_business_objs = self.business_search(term=term,
-                                                            location=location,
-                                                            latitude=latitude,
-                                                            longitude=longitude,
-                                                            radius=radius,
-                                                            categories=categories,
-                                                            locale=locale,
-                                                            limit=min(limit, num_businesses_left),
-                                                            offset= offset + len(business_objs),
-                                                            sort_by=sort_by,
-                                                            price=price,
-                                                            open_now=open_now,
-                                                            open_at=open_at,
-                                                            attributes=attributes,
-                                                            add_parent_categories=add_parent_categories,
-                                                            max_num_businesses=max_num_businesses)['businesses']
-            business_objs.extend(additional_business_objs)
-
-        result = {
+        return params
+
+    def _process_business_search_response(self, response, add_parent_categories):
+        return {
             "total": response['total'],
-            "businesses": business_objs,
+            "businesses": self._process_business_search_businesses(response['businesses'], add_parent_categories),
             "latitude": response['region']['center']['latitude'],
             "longitude": response['region']['center']['longitude']
         }
-        return result
 
     def _process_business_search_businesses(self, businesses, add_parent_categories):
         business_objs = []
@@ -314,6 +412,52 @@ class YelpAPI():
         return self._process_business_detail(result, add_parent_categories)
 
     def graphql_bulk_business_hours(self, ids):
+        resp = self._graphql_request_raw(self._bulk_business_hours_query(ids))
+        if resp.get('data') is None:
+            raise Exception("Hours query failed: {}".format(resp.get('errors', resp)))
+        hours = self._process_bulk_business_hours_response(ids, resp)
+        return [hours[biz_id] for biz_id in ids]
+
+    def bulk_business_hours(self, ids, max_query_cost=None, max_concurrency=4):
+        """
+        Fetches hours for any number of businesses. Ids whose hours are already known (from an earlier call)
+        are skipped, the rest are split into batches that fit in max_query_cost and fetched concurrently.
+        If a whole batch fails it's split in half and retried. If Yelp only fails on some businesses in a
+        batch, only those get None.
+        :return: Dict mapping business id to hours (None if it has no hours or the lookup failed).
+        """
+        if max_query_cost is None:
+            max_query_cost = self.HOURS_QUERY_MAX_COST
+        to_fetch = [biz_id for biz_id in dict.fromkeys(ids) if biz_id not in self.known_hours]
+        if len(to_fetch) > 0:
+            batch_size = max(1, max_query_cost // self.HOURS_QUERY_COST_PER_BUSINESS)
+            batches = [to_fetch[i:i + batch_size] for i in range(0, len(to_fetch), batch_size)]
+            with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+                fetched = list(executor.map(self._fetch_hours_batch, batches))
+        else:
+            fetched = []
+        hours = {}
+        for batch_hours in fetched:
+            hours.update(batch_hours)
+        return {biz_id: hours.get(biz_id, self.known_hours.get(biz_id)) for biz_id in ids}
+
+    def _fetch_hours_batch(self, ids):
+        import requests
+        try:
+            resp = self._graphql_request_raw(self._bulk_business_hours_query(ids))
+        except (requests.RequestException, ValueError):
+            resp = {}
+        if resp.get('data') is None:
+            # The whole query failed (e.g. it was too expensive), so try again in smaller pieces
+            if len(ids) == 1:
+                return {ids[0]: None}
+            mid = len(ids) // 2
+            hours = self._fetch_hours_batch(ids[:mid])
+            hours.update(self._fetch_hours_batch(ids[mid:]))
+            return hours
+        return self._process_bulk_business_hours_response(ids, resp)
+
+    def _bulk_business_hours_query(self, ids):
         business_query_str = """
           b{0}: business(id: "{1}") {{
             name
@@ -332,25 +476,36 @@ class YelpAPI():
         formatted_businesses = []
         for idx, biz_id in enumerate(ids):
             formatted_businesses.append(business_query_str.format(idx, biz_id))
-        query = "{{ {0} }}".format("\n".join(formatted_businesses))
-        results = self._graphql_request(query)
+        return "{{ {0} }}".format("\n".join(formatted_businesses))
 
-        all_hours = []
-        print(results)
-        for i in range(len(ids)):
-            result = results["b{0}".format(i)]
+    def _process_bulk_business_hours_response(self, ids, resp):
+        # Businesses that errored come back as null and/or are named in the path of an error
+        failed_aliases = set()
+        for error in resp.get('errors') or []:
+            path = error.get('path') or []
+            if len(path) > 0:
+                failed_aliases.add(path[0])
+        data = resp['data']
+        all_hours = {}
+        for i, biz_id in enumerate(ids):
+            alias = "b{0}".format(i)
+            result = data.get(alias)
+            if result is None or alias in failed_aliases:
+                all_hours[biz_id] = None
+                continue
             hours_raw = result.get('hours')
             hours = None
             if hours_raw is not None:
                 hours = self._reformat_business_hours(hours_raw)
-            all_hours.append(hours)
+            all_hours[biz_id] = hours
+            self.known_hours[biz_id] = hours
         return all_hours
 
-    def add_hours_to_search_results(self, results):
-        ids = [r.id for r in results]
-        hours = self.graphql_bulk_business_hours(ids)
-        for i in range(len(results)):
-            results[i].hours = hours[i]
+    def add_hours_to_search_results(self, results, max_query_cost=None, max_concurrency=4):
+        missing = [r for r in results if r.hours is None]
+        hours = self.bulk_business_hours([r.id for r in missing], max_query_cost, max_concurrency)
+        for r in missing:
+            r.hours = hours[r.id]
 
     def _reformat_business_hours(self, hours_raw):
         # Change format of hours to a list. One element for each day,
@@ -415,17 +570,27 @@ class YelpAPI():
                      excluded_events=None,
                      timezone=None,
                      duration_if_no_end=datetime.timedelta(seconds=3600 * 2)): # Default duration 2hrs if no end time
-        if timezone is None:
-            raise Exception("Must specify timezone")
-        start_date = str_to_unix(start_date, timezone)
-        end_date = str_to_unix(end_date, timezone)
         params = dict(locals())
+        del params['self']
+        response = self._request("events", self._event_search_params(params))
+        return self._process_event_search_response(response, timezone, duration_if_no_end)
+
+    def _event_search_params(self, search_args):
+        # Turn event_search's arguments into request parameters
+        params = dict(search_args)
+        if params['timezone'] is None:
+            raise Exception("Must specify timezone")
+        params['start_date'] = str_to_unix(params['start_date'], params['timezone'])
+        params['end_date'] = str_to_unix(params['end_date'], params['timezone'])
         #del params['add_parent_categories']
         keys = list(params.keys())
         for k in keys:
             if params[k] is None:
                 del params[k]
-        response = self._request("events", params)
+        return params
+
+    def _process_event_search_response(self, response, timezone, duration_if_no_end):
+        import dateutil.parser
         events = response["events"]
         event_objs = []
         print([x['id'] for x in events])
@@ -466,5 +631,3 @@ class YelpAPI():
             )
         print(events[0]['time_start'])
         return event_objs
-
-
@@ -0,0 +1,9 @@
+"""
+Offline performance benchmarks for graph building and plan search on seeded synthetic cities.
+
+    python -m benchmarks.run                         # run everything and print a report
+    python -m benchmarks.run --quick --save base.json
+    python -m benchmarks.run --quick --baseline base.json
+
+See benchmarks/run.py for the scenarios and benchmarks/synthetic_city.py for the city generator.
+"""
@@ -0,0 +1,282 @@
+"""
+Benchmark scenarios for graph building, opening hours checks and plan search, run on synthetic cities.
+
+Each scenario reports wall clock time (best of --repeat runs), throughput and, unless --no-memory is given, peak
+traced memory from a separate run under tracemalloc (tracing slows everything down, so it's never timed).
+Results can be saved as JSON and later runs compared against them:
+
+    python -m benchmarks.run --save baseline.json
+    python -m benchmarks.run --baseline baseline.json --tolerance 0.15
+
+Comparing exits with status 1 if any throughput / time / memory metric got worse by more than the tolerance.
+"""
+import argparse
+import datetime
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from algo import Entity, build_entity_graph, build_initial_states
+from benchmarks.synthetic_city import DAY_OUT_SEQUENCE, generate_city
+from constraints import StateConstraints
+from layered import LayeredSearch
+from plan import generate_plans, plan_count
+from shortcuts import category_sequence_search_fns
+from timing import Timeline
+
+# Metrics where bigger is better end in this, time and memory metrics are better smaller. Anything else is a
+# count describing the work done (edges, plans...), which should only change if behavior did.
+HIGHER_IS_BETTER_SUFFIX = "_per_sec"
+LOWER_IS_BETTER = ("seconds", "peak_mb")
+
+SEARCH_START_DTS = [datetime.datetime(2020, 6, 6, 10), datetime.datetime(2020, 6, 6, 13)]
+SEARCH_MAX_DISTANCE = 800
+
+
+def _make_entities(businesses, events=()):
+    return [Entity(business=b) for b in businesses] + [Entity(event=e) for e in events]
+
+
+def _dwell_fn(num_options):
+    options = [datetime.timedelta(minutes=m) for m in (60, 90, 45, 120, 30)[:num_options]]
+    def time_spent_fn(entity):
+        return options
+    return time_spent_fn
+
+
+class Scenario:
+    """
+    A named benchmark. setup() builds its inputs (not timed), run(inputs) does the timed work and returns a
+    dict of counts, from which throughput metrics are derived.
+    """
+    def __init__(self, name, setup, run, throughput):
+        """
+        :param throughput: Dict of metric name -> count name. Each becomes count / seconds.
+        """
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.throughput = throughput
+
+
+def graph_build_scenario(num_businesses, num_events, seed=0):
+    businesses, events = generate_city(num_businesses, num_events, seed=seed)
+    sequence = DAY_OUT_SEQUENCE[:4]
+
+    def setup():
+        # Fresh entities each time so compiled hours and category masks aren't reused between runs
+        return _make_entities(businesses, events)
+
+    def run(entities):
+        graph = build_entity_graph(entities, category_sequence=sequence, max_distance=1500, compact=True)
+        return {"nodes": len(graph.nodes), "edges": graph.num_edges(), "pairs": len(entities) ** 2}
+
+    return Scenario("graph_build/n={}".format(num_businesses + num_events), setup, run,
+                    {"edges_per_sec": "edges", "pairs_per_sec": "pairs"})
+
+
+def open_hours_scenario(num_businesses, num_checks, seed=0):
+    businesses, events = generate_city(num_businesses, num_businesses // 10, seed=seed)
+
+    def setup():
+        entities = _make_entities(businesses, events)
+        rng = random.Random(seed)
+        timeline = Timeline(SEARCH_START_DTS[0])
+        checks = [(rng.choice(entities), rng.randrange(7 * 24 * 60)) for _ in range(num_checks)]
+        for entity in entities:
+            # Compile outside the timed part
+            entity.open_at_minute(0, timeline)
+        return timeline, checks
+
+    def run(inputs):
+        timeline, checks = inputs
+        num_open = 0
+        for entity, minute in checks:
+            if entity.open_at_minute(minute, timeline):
+                num_open += 1
+        return {"checks": len(checks), "open": num_open}
+
+    return Scenario("open_hours/checks={}".format(num_checks), setup, run, {"checks_per_sec": "checks"})
+
+
+def search_scenario(name, num_businesses, sequence_length, num_dwell_options, seed=0):
+    businesses, events = generate_city(num_businesses, num_businesses // 20, seed=seed)
+    sequence = DAY_OUT_SEQUENCE[:sequence_length]
+    time_spent_fn = _dwell_fn(num_dwell_options)
+
+    def setup():
+        entities = _make_entities(businesses, events)
+        graph = build_entity_graph(entities, category_sequence=sequence, max_distance=SEARCH_MAX_DISTANCE,
+                                   time_spent_fn=time_spent_fn)
+        initial_states = build_initial_states(graph, SEARCH_START_DTS,
+                                              StateConstraints().curr_state_category_in(sequence[0]))
+        neighbor_state_fn, success_state_fn = category_sequence_search_fns(sequence)
+        return graph, initial_states, neighbor_state_fn, success_state_fn
+
+    def run(inputs):
+        graph, initial_states, neighbor_state_fn, success_state_fn = inputs
+        counts = {"states": len(initial_states)}
+        def counting_neighbor_state_fn(constraint_params):
+            neighbors = neighbor_state_fn(constraint_params)
+            counts["states"] += len(neighbors)
+            return neighbors
+        plans = generate_plans(graph, initial_states, counting_neighbor_state_fn, success_state_fn, None)
+        counts["plans"] = len(plans)
+        return counts
+
+    return Scenario("search/{}".format(name), setup, run, {"states_per_sec": "states"})
+
+
+def layered_search_scenario(name, num_businesses, sequence_length, num_dwell_options, seed=0):
+    # Same inputs as search_scenario, searched with the layered engine instead
+    businesses, events = generate_city(num_businesses, num_businesses // 20, seed=seed)
+    sequence = DAY_OUT_SEQUENCE[:sequence_length]
+    time_spent_fn = _dwell_fn(num_dwell_options)
+
+    def setup():
+        entities = _make_entities(businesses, events)
+        graph = build_entity_graph(entities, category_sequence=sequence, max_distance=SEARCH_MAX_DISTANCE,
+                                   time_spent_fn=time_spent_fn)
+        return LayeredSearch(graph, sequence)
+
+    def run(search):
+        final_states = search.run(SEARCH_START_DTS)
+        return {"states": sum(len(states) for states in search.layers), "plans": plan_count(final_states)}
+
+    return Scenario("layered/{}".format(name), setup, run, {"states_per_sec": "states", "plans_per_sec": "plans"})
+
+
+def build_scenarios(quick=False):
+    scenarios = []
+    for n in ((1000, 2000) if quick else (1000, 2000, 4000)):
+        scenarios.append(graph_build_scenario(n, n // 20))
+    scenarios.append(open_hours_scenario(1000, 100000 if quick else 500000))
+    # Search scaling in city size, plan length and number of dwell options, one at a time
+    for n in ((300, 600) if quick else (300, 600, 900)):
+        scenarios.append(search_scenario("n={}".format(n), n, 3, 2))
+    for length in ((2, 4) if quick else (2, 3, 4, 5)):
+        scenarios.append(search_scenario("seq={}".format(length), 300, length, 2))
+    for num_options in ((1, 3) if quick else (1, 2, 3, 4)):
+        scenarios.append(search_scenario("dwell={}".format(num_options), 300, 3, num_options))
+    for length in ((2, 4) if quick else (2, 3, 4, 5)):
+        scenarios.append(layered_search_scenario("seq={}".format(length), 300, length, 2))
+    return scenarios
+
+
+def run_scenario(scenario, repeat=3, measure_memory=True):
+    best = None
+    counts = None
+    for _ in range(repeat):
+        inputs = scenario.setup()
+        start = time.perf_counter()
+        counts = scenario.run(inputs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    result = dict(counts)
+    result["seconds"] = best
+    for metric, count_name in scenario.throughput.items():
+        result[metric] = counts[count_name] / best if best > 0 else float("inf")
+
+    if measure_memory:
+        inputs = scenario.setup()
+        tracemalloc.start()
+        try:
+            scenario.run(inputs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result["peak_mb"] = peak / 2 ** 20
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of (scenario, metric, old, new, status) rows, status being "ok", "better", "worse",
+    "changed" (a count differs) or "new".
+    """
+    rows = []
+    for name, metrics in results.items():
+        old_metrics = baseline.get(name)
+        if old_metrics is None:
+            rows.append((name, "", None, None, "new"))
+            continue
+        for metric, new in metrics.items():
+            old = old_metrics.get(metric)
+            if old is None:
+                continue
+            if metric.endswith(HIGHER_IS_BETTER_SUFFIX):
+                ratio = new / old if old else float("inf")
+                status = "worse" if ratio < 1 - tolerance else "better" if ratio > 1 + tolerance else "ok"
+            elif metric in LOWER_IS_BETTER:
+                ratio = new / old if old else float("inf")
+                status = "worse" if ratio > 1 + tolerance else "better" if ratio < 1 - tolerance else "ok"
+            else:
+                status = "ok" if new == old else "changed"
+            rows.append((name, metric, old, new, status))
+    return rows
+
+
+def _format(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "{:.4g}".format(value)
+    return str(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes and a single run of each scenario")
+    parser.add_argument("--repeat", type=int, default=None, help="Runs per scenario, the best time is kept")
+    parser.add_argument("--filter", default=None, help="Only run scenarios whose name contains this")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the tracemalloc peak memory runs")
+    parser.add_argument("--save", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative slowdown when comparing")
+    args = parser.parse_args(argv)
+
+    repeat = args.repeat if args.repeat is not None else (1 if args.quick else 3)
+    results = {}
+    for scenario in build_scenarios(quick=args.quick):
+        if args.filter is not None and args.filter not in scenario.name:
+            continue
+        result = run_scenario(scenario, repeat=repeat, measure_memory=not args.no_memory)
+        results[scenario.name] = result
+        print("{:<28} {}".format(scenario.name, "  ".join("{}={}".format(k, _format(v)) for k, v in result.items())),
+              flush=True)
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump({
+                "meta": {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "quick": args.quick,
+                    "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                },
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        rows = compare(results, baseline, args.tolerance)
+        print()
+        print("{:<28} {:<18} {:>12} {:>12}  {}".format("scenario", "metric", "baseline", "current", "status"))
+        for name, metric, old, new, status in rows:
+            if status != "ok":
+                print("{:<28} {:<18} {:>12} {:>12}  {}".format(name, metric, _format(old), _format(new), status))
+        num_worse = sum(1 for row in rows if row[4] == "worse")
+        num_changed = sum(1 for row in rows if row[4] == "changed")
+        print("{} metrics compared, {} worse, {} counts changed".format(len(rows), num_worse, num_changed))
+        if num_worse > 0:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
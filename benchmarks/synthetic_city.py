@@ -0,0 +1,198 @@
+"""
+Seeded generator of synthetic cities: businesses clustered into neighborhoods with Yelp style categories and
+opening hours (including overnight bars and split lunch / dinner hours), plus timed events. Everything comes
+from one random.Random(seed), so the same arguments always give the same city.
+"""
+import datetime
+import math
+import random
+
+from api.yelp.yelp import BusinessSearchResult, EventSearchResult
+
+METERS_PER_DEGREE_LAT = 111320.0
+
+# Kinds of business: (weight, categories with their parent categories, hours pattern)
+BUSINESS_KINDS = [
+    (10, ["restaurants", "food", "italian"], "split"),
+    (10, ["restaurants", "food", "mexican"], "split"),
+    (8, ["restaurants", "food", "japanese"], "split"),
+    (6, ["food", "coffee"], "morning"),
+    (4, ["food", "bakeries"], "morning"),
+    (8, ["nightlife", "bars"], "overnight"),
+    (3, ["nightlife", "bars", "cocktailbars"], "overnight"),
+    (2, ["nightlife", "danceclubs"], "late"),
+    (3, ["arts", "museums"], "museum"),
+    (2, ["arts", "galleries"], "museum"),
+    (1, ["arts", "theater"], "evening"),
+    (4, ["active", "parks"], "park"),
+    (2, ["active", "gyms"], "all_day"),
+    (5, ["shopping", "fashion"], "retail"),
+    (3, ["shopping", "bookstores"], "retail"),
+]
+
+EVENT_CATEGORIES = ["music", "visual-arts", "performing-arts", "film", "food-and-drink", "festivals-fairs",
+                    "nightlife"]
+
+# Category sequences for search scenarios, one entry per stop
+DAY_OUT_SEQUENCE = [["coffee", "bakeries"], ["museums", "galleries"], ["restaurants"], ["parks", "shopping"],
+                    ["bars"], ["danceclubs", "cocktailbars"]]
+
+
+def _time(minutes):
+    minutes %= 24 * 60
+    return datetime.time(minutes // 60, minutes % 60)
+
+
+def _span(rng, start_hour_range, length_hour_range):
+    # Opening time on the half hour, open for a whole number of half hours
+    start = rng.randint(start_hour_range[0] * 2, start_hour_range[1] * 2) * 30
+    length = rng.randint(length_hour_range[0] * 2, length_hour_range[1] * 2) * 30
+    end = start + length
+    return {"start": _time(start), "end": _time(end), "is_overnight": end > 24 * 60}
+
+
+def make_hours(rng, pattern):
+    """
+    Returns a week of hours (one list of spans per weekday, Monday first) for the given pattern.
+    """
+    hours = []
+    for day in range(7):
+        weekend = day >= 5
+        spans = []
+        if pattern == "split":
+            # Lunch and dinner, some places skip lunch or close a day a week
+            if day == 0 and rng.random() < 0.3:
+                pass
+            else:
+                if rng.random() < 0.8:
+                    spans.append(_span(rng, (11, 12), (3, 4)))
+                spans.append(_span(rng, (17, 18), (4, 6)))
+        elif pattern == "morning":
+            spans.append(_span(rng, (6, 8) if not weekend else (7, 9), (7, 10)))
+        elif pattern == "overnight":
+            spans.append(_span(rng, (15, 18), (8, 11)))
+        elif pattern == "late":
+            if day >= 3:
+                spans.append(_span(rng, (21, 23), (5, 7)))
+        elif pattern == "museum":
+            if day != 0:
+                spans.append(_span(rng, (9, 10), (7, 9) if day != 3 else (9, 11)))
+        elif pattern == "evening":
+            if day != 0:
+                spans.append(_span(rng, (18, 19), (3, 5)))
+        elif pattern == "park":
+            spans.append(_span(rng, (5, 7), (14, 17)))
+        elif pattern == "all_day":
+            spans.append({"start": datetime.time(0, 0), "end": datetime.time(0, 0), "is_overnight": True}
+                         if rng.random() < 0.3 else _span(rng, (5, 6), (16, 18)))
+        elif pattern == "retail":
+            spans.append(_span(rng, (9, 11), (8, 11) if not weekend else (6, 8)))
+        hours.append(spans)
+    return hours
+
+
+class SyntheticCity:
+    """
+    A city of businesses scattered around neighborhood centers inside radius meters of center.
+    Neighborhoods favor different kinds of business (a nightlife district, a museum mile, ...), so category
+    mixes vary across the city the way they do in real ones.
+    """
+    def __init__(self, seed=0, center=(40.7306, -73.9866), radius=5000, num_neighborhoods=12):
+        self.seed = seed
+        self.center = center
+        self.radius = radius
+        self.rng = random.Random(seed)
+        self.neighborhoods = []
+        for _ in range(num_neighborhoods):
+            lat, lon = self._offset(self.rng.uniform(0, radius * 0.8), self.rng.uniform(0, 2 * math.pi))
+            # Each neighborhood boosts a few kinds of business
+            boosts = [1.0] * len(BUSINESS_KINDS)
+            for kind_idx in self.rng.sample(range(len(BUSINESS_KINDS)), 3):
+                boosts[kind_idx] = self.rng.uniform(3, 8)
+            self.neighborhoods.append({
+                "lat": lat,
+                "lon": lon,
+                "spread": self.rng.uniform(radius * 0.05, radius * 0.2),
+                "weights": [kind[0] * boost for kind, boost in zip(BUSINESS_KINDS, boosts)],
+                "size": self.rng.uniform(0.5, 2.0),
+            })
+
+    def _offset(self, dist, bearing, origin=None):
+        lat0, lon0 = origin if origin is not None else self.center
+        dlat = dist * math.cos(bearing) / METERS_PER_DEGREE_LAT
+        dlon = dist * math.sin(bearing) / (METERS_PER_DEGREE_LAT * math.cos(math.radians(lat0)))
+        return lat0 + dlat, lon0 + dlon
+
+    def _location(self):
+        rng = self.rng
+        if rng.random() < 0.15:
+            # Some places are scattered anywhere in the city
+            hood = None
+            lat, lon = self._offset(self.radius * math.sqrt(rng.random()), rng.uniform(0, 2 * math.pi))
+        else:
+            hood = rng.choices(self.neighborhoods, weights=[h["size"] for h in self.neighborhoods])[0]
+            lat, lon = self._offset(abs(rng.gauss(0, hood["spread"])), rng.uniform(0, 2 * math.pi),
+                                    origin=(hood["lat"], hood["lon"]))
+        return hood, lat, lon
+
+    def businesses(self, n):
+        """
+        Returns n BusinessSearchResults with hours filled in.
+        """
+        rng = self.rng
+        out = []
+        for i in range(n):
+            hood, lat, lon = self._location()
+            weights = hood["weights"] if hood is not None else [kind[0] for kind in BUSINESS_KINDS]
+            _, categories, pattern = rng.choices(BUSINESS_KINDS, weights=weights)[0]
+            categories = set(categories)
+            # Plenty of places are also something else (a bar that serves food, a cafe with a gallery...)
+            if rng.random() < 0.25:
+                categories.update(rng.choice(BUSINESS_KINDS)[1])
+            out.append(BusinessSearchResult(
+                id="biz-{}-{}".format(self.seed, i),
+                alias="biz-{}-{}".format(self.seed, i),
+                name="Business {}".format(i),
+                latitude=lat,
+                longitude=lon,
+                categories=categories,
+                rating=rng.choice([2.5, 3.0, 3.5, 3.5, 4.0, 4.0, 4.0, 4.5, 4.5, 5.0]),
+                price="$" * rng.choices([1, 2, 3, 4], weights=[4, 5, 2, 1])[0],
+                review_count=int(rng.paretovariate(1.2) * 10),
+                location={"display_address": ["{} Synthetic St".format(i)]},
+                hours=make_hours(rng, pattern)))
+        return out
+
+    def events(self, n, start_date=datetime.date(2020, 6, 1), num_days=7):
+        """
+        Returns n EventSearchResults spread over num_days days from start_date. Most last a few hours, a few
+        run for days (festivals, exhibitions).
+        """
+        rng = self.rng
+        out = []
+        for i in range(n):
+            _, lat, lon = self._location()
+            day = start_date + datetime.timedelta(days=rng.randrange(num_days))
+            start = datetime.datetime.combine(day, datetime.time(rng.randint(9, 22), rng.choice([0, 30])))
+            if rng.random() < 0.1:
+                duration = datetime.timedelta(days=rng.randint(1, 4))
+            else:
+                duration = datetime.timedelta(minutes=rng.randint(2, 8) * 30)
+            out.append(EventSearchResult(
+                id="event-{}-{}".format(self.seed, i),
+                name="Event {}".format(i),
+                categories={"event", rng.choice(EVENT_CATEGORIES)},
+                latitude=lat,
+                longitude=lon,
+                start_time=start,
+                end_time=start + duration,
+                is_free=rng.random() < 0.4))
+        return out
+
+
+def generate_city(num_businesses, num_events=0, seed=0, **kwargs):
+    """
+    Returns (businesses, events) for a synthetic city. Extra arguments go to SyntheticCity.
+    """
+    city = SyntheticCity(seed=seed, **kwargs)
+    return city.businesses(num_businesses), city.events(num_events)
@@ -0,0 +1,278 @@
+"""
+Category aliases interned to integer ids, so a set of categories can be stored and compared as an int bitmask
+(bit i set if the category with id i is in the set). Each category's ancestors are precomputed from the
+taxonomy, so expanding a set with its parent categories is an OR of precomputed masks.
+"""
+import hashlib
+import json
+import os
+import pickle
+import threading
+
+# Bump when CompiledTaxonomy's serialized form changes so stale cache files are ignored
+TAXONOMY_CACHE_VERSION = 1
+DEFAULT_TAXONOMY_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "dayplanner")
+
+
+class CategoryIndex:
+    """
+    Safe to share between threads: interning a new alias and changing the taxonomy take a lock, so concurrent
+    fetches can't hand out the same id twice. Looking up aliases that are already interned doesn't.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.aliases = []
+        self.parents = []
+        # Mask of each category plus all of its ancestors. Computed lazily, reset when the taxonomy changes.
+        self._closures = []
+        self._lock = threading.RLock()
+        # CompiledTaxonomies already merged by add_compiled, so adding one again is free
+        self._merged_compiled = []
+
+    def __getstate__(self):
+        # Entities pickle their index along with them (e.g. for generate_plans_parallel), locks can't be pickled
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_taxonomy(cls, taxonomy):
+        index = cls()
+        index.add_taxonomy(taxonomy)
+        return index
+
+    def add_taxonomy(self, taxonomy):
+        """
+        :param taxonomy: Dict mapping category alias to a dict with a "parents" list of aliases
+                         (e.g. YelpAPI.BIZ_CATEGORIES).
+        """
+        with self._lock:
+            # Intern in sorted order so the same taxonomy always gives the same ids
+            for alias in sorted(taxonomy):
+                self.intern(alias)
+            for alias in sorted(taxonomy):
+                alias_id = self.ids[alias]
+                self.parents[alias_id] = [self.intern(parent) for parent in taxonomy[alias]['parents']]
+            self._closures = [None] * len(self.aliases)
+
+    def add_compiled(self, compiled):
+        """
+        Same as add_taxonomy, but for a CompiledTaxonomy. Into an empty index this just adopts the compiled
+        ids and closures. Adding the same CompiledTaxonomy again does nothing (load_compiled_taxonomy returns
+        the same object for the same file, so every client built on a shared index can add it cheaply).
+        """
+        if any(merged is compiled for merged in self._merged_compiled):
+            return
+        with self._lock:
+            if any(merged is compiled for merged in self._merged_compiled):
+                return
+            self._merged_compiled.append(compiled)
+            if len(self.aliases) == 0:
+                self.parents = [list(parent_ids) for parent_ids in compiled.parents]
+                self._closures = list(compiled.closures)
+                # Aliases before ids, so an id read without the lock always has its alias
+                self.aliases = list(compiled.aliases)
+                self.ids = {alias: alias_id for alias_id, alias in enumerate(self.aliases)}
+                return
+            alias_ids = [self.intern(alias) for alias in compiled.aliases]
+            for alias_id, parent_ids in zip(alias_ids, compiled.parents):
+                self.parents[alias_id] = [alias_ids[parent_id] for parent_id in parent_ids]
+            self._closures = [None] * len(self.aliases)
+
+    def intern(self, alias):
+        alias_id = self.ids.get(alias)
+        if alias_id is None:
+            with self._lock:
+                # Another thread may have interned it while we waited
+                alias_id = self.ids.get(alias)
+                if alias_id is None:
+                    alias_id = len(self.aliases)
+                    self.parents.append([])
+                    self._closures.append(None)
+                    self.aliases.append(alias)
+                    self.ids[alias] = alias_id
+        return alias_id
+
+    def mask(self, aliases):
+        """
+        Returns the bitmask of the given categories (unknown categories are interned).
+        """
+        mask = 0
+        if aliases is not None:
+            for alias in aliases:
+                mask |= 1 << self.intern(alias)
+        return mask
+
+    def closure(self, alias_id):
+        """
+        Returns the mask of a category and all of its ancestors.
+        """
+        closure = self._closures[alias_id]
+        if closure is None:
+            with self._lock:
+                closure = self._compute_closure(alias_id, set())
+        return closure
+
+    def _compute_closure(self, alias_id, in_progress):
+        closure = self._closures[alias_id]
+        if closure is not None:
+            return closure
+        # Skip categories already being computed so a cycle in the taxonomy can't recurse forever. Nothing is
+        # stored until a closure is finished, so readers without the lock never see a partial one.
+        in_progress.add(alias_id)
+        closure = 1 << alias_id
+        for parent_id in self.parents[alias_id]:
+            if parent_id not in in_progress:
+                closure |= self._compute_closure(parent_id, in_progress)
+        self._closures[alias_id] = closure
+        return closure
+
+    def closure_mask(self, aliases):
+        """
+        Returns the mask of the given categories and all of their ancestors.
+        """
+        mask = 0
+        if aliases is not None:
+            for alias in aliases:
+                mask |= self.closure(self.intern(alias))
+        return mask
+
+    def aliases_of(self, mask):
+        out = set()
+        while mask:
+            low_bit = mask & -mask
+            out.add(self.aliases[low_bit.bit_length() - 1])
+            mask ^= low_bit
+        return out
+
+    def expand(self, aliases):
+        """
+        Returns the set of categories plus all of their ancestors.
+        """
+        if aliases is None:
+            return None
+        return self.aliases_of(self.closure_mask(aliases))
+
+
+class CompiledTaxonomy:
+    """
+    A category taxonomy with aliases interned (in sorted order), parents as ids and every category's
+    ancestor closure precomputed. Serializes to a compact binary form so it can be cached.
+    """
+    def __init__(self, aliases, titles, parents, closures):
+        self.aliases = aliases
+        self.titles = titles
+        self.parents = parents
+        self.closures = closures
+
+    @classmethod
+    def from_taxonomy(cls, taxonomy):
+        index = CategoryIndex.from_taxonomy(taxonomy)
+        titles = [taxonomy[alias]['title'] if alias in taxonomy else None for alias in index.aliases]
+        closures = [index.closure(alias_id) for alias_id in range(len(index.aliases))]
+        return cls(index.aliases, titles, index.parents, closures)
+
+    def to_taxonomy(self):
+        """
+        Returns the taxonomy as a dict of alias -> {"title": ..., "parents": [...]}, like YelpAPI.BIZ_CATEGORIES.
+        Parents missing from the original taxonomy aren't included.
+        """
+        taxonomy = {}
+        for alias, title, parent_ids in zip(self.aliases, self.titles, self.parents):
+            if title is not None:
+                taxonomy[alias] = {"title": title, "parents": [self.aliases[parent_id] for parent_id in parent_ids]}
+        return taxonomy
+
+    def dumps(self):
+        return pickle.dumps((TAXONOMY_CACHE_VERSION, self.aliases, self.titles, self.parents, self.closures),
+                            protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def loads(cls, data):
+        version, aliases, titles, parents, closures = pickle.loads(data)
+        if version != TAXONOMY_CACHE_VERSION:
+            raise ValueError("Unsupported taxonomy cache version {}".format(version))
+        return cls(aliases, titles, parents, closures)
+
+
+def _parse_categories(raw):
+    # Yelp categories JSON -> dict of alias -> {"title": ..., "parents": [...]}
+    categories = {}
+    for elem in json.loads(raw):
+        categories[elem['alias']] = {"title": elem['title'], "parents": elem['parents']}
+    return categories
+
+
+# (path, mtime, size) -> CompiledTaxonomy, so each process compiles or loads a file at most once
+_compiled_taxonomies = {}
+
+
+def load_compiled_taxonomy(categories_file, cache_dir=DEFAULT_TAXONOMY_CACHE_DIR):
+    """
+    Returns the CompiledTaxonomy for a Yelp categories JSON file. The compiled form is cached in cache_dir
+    under the hash of the file's contents, so the JSON is only parsed the first time a given file is seen.
+    :param cache_dir: Directory for compiled taxonomy files. None disables the on-disk cache.
+    """
+    stat = os.stat(categories_file)
+    memo_key = (os.path.abspath(categories_file), stat.st_mtime_ns, stat.st_size)
+    compiled = _compiled_taxonomies.get(memo_key)
+    if compiled is not None:
+        return compiled
+
+    with open(categories_file, "rb") as f:
+        raw = f.read()
+    cache_path = None
+    if cache_dir is not None:
+        digest = hashlib.sha1(raw).hexdigest()
+        cache_path = os.path.join(cache_dir, "categories-{}-v{}.bin".format(digest, TAXONOMY_CACHE_VERSION))
+        try:
+            with open(cache_path, "rb") as f:
+                compiled = CompiledTaxonomy.loads(f.read())
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            compiled = None
+
+    if compiled is None:
+        compiled = CompiledTaxonomy.from_taxonomy(_parse_categories(raw))
+        if cache_path is not None:
+            # Write then rename so concurrent processes never read a partial file. The cache is only an
+            # optimization, so failing to write it is fine.
+            tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(tmp_path, "wb") as f:
+                    f.write(compiled.dumps())
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                pass
+
+    _compiled_taxonomies[memo_key] = compiled
+    return compiled
+
+
+class CategoryMasks(dict):
+    """
+    Lazily computed masks of a fixed set of categories, one per CategoryIndex. Lets constraints look up the
+    mask for whichever index the entities they're checking were interned with.
+    """
+    def __init__(self, aliases):
+        super().__init__()
+        self.category_aliases = list(aliases)
+
+    def __missing__(self, index):
+        mask = index.mask(self.category_aliases)
+        self[index] = mask
+        return mask
+
+
+_default_index = CategoryIndex()
+
+
+def default_category_index():
+    """
+    The CategoryIndex entities use unless given another one.
+    """
+    return _default_index
@@ -0,0 +1,611 @@
+"""
+Declarative versions of the constraints in constraints.py.
+The builders here mirror BooleanConstraints, StateConstraints, etc. but return expression trees instead of
+closures. Expressions are callable, so they can be used anywhere a constraint can, but they can also be
+compiled into a single fused predicate, and the parts that only depend on the two nodes of an edge can be
+moved into graph building (see edge_filter).
+"""
+
+from utils import meters_to_miles
+from categories import CategoryMasks
+from algo import build_state_key_fn
+
+# What an expression reads, from least to most. Anything up to EDGE only needs the current node, the next node
+# and the properties of the edge between them, so it can be evaluated once per edge when the graph is built.
+CONST = 0
+NODE = 1
+EDGE = 2
+STATE = 3
+
+
+class MissingStateKeyException(Exception):
+    def __init__(self, key):
+        message = "Missing state dependent key {}".format(key)
+        super(Exception, self).__init__(message)
+
+
+def _raise_missing_key(key):
+    raise MissingStateKeyException(key)
+
+
+def _union_state_attrs(parts):
+    # None (unknown) wins over everything
+    attrs = set()
+    for part in parts:
+        part_attrs = part.state_attrs()
+        if part_attrs is None:
+            return None
+        attrs |= part_attrs
+    return attrs
+
+
+class _CompileContext:
+    """
+    Tracks the names bound into the generated code's namespace and how to reach the nodes being checked.
+    In search mode the predicate takes ConstraintParams (p). In edge mode it takes (node_a, node_b, props).
+    """
+    def __init__(self, edge_mode=False, graph=None):
+        self.edge_mode = edge_mode
+        self.graph = graph
+        self.namespace = {"_raise_missing_key": _raise_missing_key}
+        self._num_names = 0
+
+    def bind(self, value, prefix="_c"):
+        name = "{}{}".format(prefix, self._num_names)
+        self._num_names += 1
+        self.namespace[name] = value
+        return name
+
+    def fresh_name(self, prefix):
+        self._num_names += 1
+        return "{}{}".format(prefix, self._num_names)
+
+    def state(self, use_next):
+        if self.edge_mode:
+            raise ValueError("State dependent expressions can't be evaluated per edge")
+        return "p.next_state" if use_next else "p.curr_state"
+
+    def node(self, use_next):
+        if self.edge_mode:
+            return "node_b" if use_next else "node_a"
+        return "{}.node".format(self.state(use_next))
+
+    def edge_properties(self):
+        if self.edge_mode:
+            return "props"
+        return "p.graph.get_edge_properties(p.curr_state.node, p.next_state.node)"
+
+
+class Expr:
+    """
+    Base class for boolean constraint expressions.
+    """
+    scope = STATE
+
+    def __call__(self, constraint_params):
+        fn = self.__dict__.get('_compiled')
+        if fn is None:
+            fn = compile_constraint(self)
+            self._compiled = fn
+        return fn(constraint_params)
+
+    def __getstate__(self):
+        # Compiled functions can't be pickled, they're rebuilt on first use
+        state = dict(self.__dict__)
+        state.pop('_compiled', None)
+        return state
+
+    def emit(self, ctx):
+        """
+        Returns Python source for a boolean expression equivalent to this one.
+        """
+        raise NotImplementedError
+
+    def simplify(self):
+        return self
+
+    def relax(self):
+        """
+        Returns an EDGE (or lower) scoped expression that's true whenever this one is, or TRUE if there isn't a
+        useful one.
+        """
+        return self if self.scope <= EDGE else TRUE
+
+    def state_attrs(self):
+        """
+        Returns the set of PlanState attributes (besides the node and end time) whose value can change the result
+        for a state or any state after it, or None if that isn't known. See state_key_fn.
+        """
+        return set() if self.scope <= EDGE else None
+
+
+class Const(Expr):
+    scope = CONST
+
+    def __init__(self, value):
+        self.value = bool(value)
+
+    def emit(self, ctx):
+        return "True" if self.value else "False"
+
+
+TRUE = Const(True)
+FALSE = Const(False)
+
+
+def _is_const(expr, value):
+    return isinstance(expr, Const) and expr.value == value
+
+
+class And(Expr):
+    def __init__(self, exprs):
+        self.exprs = [as_expr(e) for e in exprs]
+        self.scope = max([e.scope for e in self.exprs] + [CONST])
+
+    def conjuncts(self):
+        out = []
+        for e in self.exprs:
+            out.extend(e.conjuncts() if isinstance(e, And) else [e])
+        return out
+
+    def simplify(self):
+        exprs = []
+        for e in self.conjuncts():
+            e = e.simplify()
+            if _is_const(e, False):
+                return FALSE
+            if isinstance(e, And):
+                exprs.extend(e.conjuncts())
+            elif not _is_const(e, True):
+                exprs.append(e)
+        if len(exprs) == 0:
+            return TRUE
+        return exprs[0] if len(exprs) == 1 else And(exprs)
+
+    def relax(self):
+        return And([e.relax() for e in self.exprs]).simplify()
+
+    def state_attrs(self):
+        return _union_state_attrs(self.exprs)
+
+    def emit(self, ctx):
+        if len(self.exprs) == 0:
+            return "True"
+        return "({})".format(" and ".join(e.emit(ctx) for e in self.exprs))
+
+
+class Or(Expr):
+    def __init__(self, exprs):
+        self.exprs = [as_expr(e) for e in exprs]
+        self.scope = max([e.scope for e in self.exprs] + [CONST])
+
+    def simplify(self):
+        exprs = []
+        for e in self.exprs:
+            e = e.simplify()
+            if _is_const(e, True):
+                return TRUE
+            if isinstance(e, Or):
+                exprs.extend(e.exprs)
+            elif not _is_const(e, False):
+                exprs.append(e)
+        if len(exprs) == 0:
+            return FALSE
+        return exprs[0] if len(exprs) == 1 else Or(exprs)
+
+    def relax(self):
+        return Or([e.relax() for e in self.exprs]).simplify()
+
+    def state_attrs(self):
+        return _union_state_attrs(self.exprs)
+
+    def emit(self, ctx):
+        if len(self.exprs) == 0:
+            return "False"
+        return "({})".format(" or ".join(e.emit(ctx) for e in self.exprs))
+
+
+class Not(Expr):
+    """
+    True if none of the expressions are (matches BooleanConstraints.bool_not).
+    """
+    def __init__(self, exprs):
+        self.inner = Or(exprs)
+        self.scope = self.inner.scope
+
+    def simplify(self):
+        inner = self.inner.simplify()
+        if isinstance(inner, Const):
+            return Const(not inner.value)
+        return Not([inner])
+
+    def relax(self):
+        return self if self.scope <= EDGE else TRUE
+
+    def state_attrs(self):
+        return self.inner.state_attrs()
+
+    def emit(self, ctx):
+        return "(not {})".format(self.inner.emit(ctx))
+
+
+class IfThenElse(Expr):
+    def __init__(self, if_expr, then_expr, else_expr):
+        self.if_expr, self.then_expr, self.else_expr = as_expr(if_expr), as_expr(then_expr), as_expr(else_expr)
+        self.scope = max(self.if_expr.scope, self.then_expr.scope, self.else_expr.scope)
+
+    def simplify(self):
+        if_expr = self.if_expr.simplify()
+        if isinstance(if_expr, Const):
+            return (self.then_expr if if_expr.value else self.else_expr).simplify()
+        return IfThenElse(if_expr, self.then_expr.simplify(), self.else_expr.simplify())
+
+    def relax(self):
+        if self.scope <= EDGE:
+            return self
+        return Or([self.then_expr.relax(), self.else_expr.relax()]).simplify()
+
+    def state_attrs(self):
+        return _union_state_attrs([self.if_expr, self.then_expr, self.else_expr])
+
+    def emit(self, ctx):
+        return "({} if {} else {})".format(self.then_expr.emit(ctx), self.if_expr.emit(ctx), self.else_expr.emit(ctx))
+
+
+class Compare(Expr):
+    OPERATORS = {"eq": "==", "gt": ">", "lt": "<"}
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left, self.right = as_value(left), as_value(right)
+        self.scope = max(self.left.scope, self.right.scope)
+
+    def state_attrs(self):
+        return _union_state_attrs([self.left, self.right])
+
+    def emit(self, ctx):
+        return "({} {} {})".format(self.left.emit(ctx), self.OPERATORS[self.op], self.right.emit(ctx))
+
+
+class Opaque(Expr):
+    """
+    Wraps a plain constraint function. Nothing is known about what it reads.
+    """
+    scope = STATE
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def emit(self, ctx):
+        return "{}(p)".format(ctx.bind(self.fn, "_f"))
+
+
+class NodeCategoryIn(Expr):
+    """
+    True if the current (or next) node has one of the categories.
+    """
+    scope = NODE
+
+    def __init__(self, cats, use_next=False):
+        self.cats = frozenset(cats)
+        self.use_next = use_next
+
+    def emit(self, ctx):
+        node = ctx.node(self.use_next)
+        if ctx.graph is not None:
+            # Pre-evaluate for every node in the graph
+            masks = CategoryMasks(self.cats)
+            passing = frozenset(n for n in ctx.graph.nodes if n.category_mask & masks[n.category_index])
+            return "({} in {})".format(node, ctx.bind(passing, "_n"))
+        masks = ctx.bind(CategoryMasks(self.cats), "_m")
+        return "(({0}.category_mask & {1}[{0}.category_index]) != 0)".format(node, masks)
+
+
+class CategorySeq(Expr):
+    """
+    Expression version of EdgeConstraints.category_seq.
+    """
+    def __init__(self, valid_cats_A, valid_cats_B):
+        self.curr_in = NodeCategoryIn(valid_cats_A) if valid_cats_A is not None else None
+        self.next_in = NodeCategoryIn(valid_cats_B, use_next=True) if valid_cats_B is not None else None
+        self.scope = EDGE if self.curr_in is not None else NODE
+
+    def emit(self, ctx):
+        parts = []
+        if self.curr_in is not None:
+            if ctx.edge_mode:
+                parts.append(self.curr_in.emit(ctx))
+            else:
+                # Without a current state (initial states) there's nothing to match the first category
+                parts.append("(p.curr_state is not None and {})".format(self.curr_in.emit(ctx)))
+        if self.next_in is not None:
+            parts.append(self.next_in.emit(ctx))
+        if len(parts) == 0:
+            return "True"
+        return "({})".format(" and ".join(parts))
+
+
+class PrevStateDependent(Expr):
+    """
+    Expression version of StateConstraints.prev_state_dependent.
+    :param default: Expression used for missing keys. If None, missing keys are treated as True when
+                    ignore_missing_keys is set and raise an exception otherwise.
+    """
+    scope = STATE
+
+    def __init__(self, constraint_dict, ignore_missing_keys=True, default=None):
+        self.branches = {k: as_expr(v) for k, v in constraint_dict.items()}
+        if default is None and ignore_missing_keys:
+            default = TRUE
+        self.default = as_expr(default) if default is not None else None
+
+    def simplify(self):
+        default = self.default.simplify() if self.default is not None else None
+        return PrevStateDependent({k: v.simplify() for k, v in self.branches.items()},
+                                  ignore_missing_keys=False,
+                                  default=default)
+
+    def relax(self):
+        options = [e.relax() for e in self.branches.values()]
+        if self.default is not None:
+            options.append(self.default.relax())
+        return Or(options).simplify()
+
+    def state_attrs(self):
+        parts = list(self.branches.values()) + ([self.default] if self.default is not None else [])
+        attrs = _union_state_attrs(parts)
+        return attrs | {"num_prev_states"} if attrs is not None else None
+
+    def emit(self, ctx):
+        if len(self.branches) == 0:
+            # No test to look the depth up in, so the missing key error has to read it itself
+            if self.default is not None:
+                return self.default.emit(ctx)
+            return "{}({}.num_prev_states)".format(ctx.bind(_raise_missing_key, "_r"), ctx.state(False))
+        depth = ctx.fresh_name("_d")
+        out = "{}({})".format(ctx.bind(_raise_missing_key, "_r"), depth) if self.default is None else self.default.emit(ctx)
+        for i, (key, branch) in enumerate(sorted(self.branches.items(), reverse=True)):
+            # The depth is looked up once, by the test that runs first (the last one emitted)
+            lookup = depth if i < len(self.branches) - 1 else "({} := {}.num_prev_states)".format(depth, ctx.state(False))
+            out = "({} if {} == {} else {})".format(branch.emit(ctx), lookup, ctx.bind(key), out)
+        return out
+
+
+class NoRepeatVisits(Expr):
+    scope = STATE
+
+    def state_attrs(self):
+        return {"visited_ids"}
+
+    def emit(self, ctx):
+        return "(p.next_state.prev_state is None or p.next_state.node.entity.id not in p.next_state.prev_state.visited_ids)"
+
+
+# Values compared by Compare expressions
+
+class Value:
+    scope = STATE
+
+    def emit(self, ctx):
+        raise NotImplementedError
+
+    def state_attrs(self):
+        return set() if self.scope <= EDGE else None
+
+
+class ConstValue(Value):
+    scope = CONST
+
+    def __init__(self, value):
+        self.value = value
+
+    def emit(self, ctx):
+        return ctx.bind(self.value)
+
+
+class StateAttr(Value):
+    scope = STATE
+
+    def __init__(self, attr_name, use_next=False):
+        self.attr_name = attr_name
+        self.use_next = use_next
+
+    def state_attrs(self):
+        return {self.attr_name}
+
+    def emit(self, ctx):
+        return "{}.{}".format(ctx.state(self.use_next), self.attr_name)
+
+
+class StateCategories(Value):
+    scope = NODE
+
+    def __init__(self, use_next=False):
+        self.use_next = use_next
+
+    def emit(self, ctx):
+        if ctx.edge_mode:
+            return "{}.entity.categories".format(ctx.node(self.use_next))
+        state = ctx.state(self.use_next)
+        return "({0}.node.entity.categories if {0} is not None else {1})".format(state, ctx.bind(frozenset()))
+
+
+class EdgeDistance(Value):
+    scope = EDGE
+
+    def __init__(self, use_miles=False):
+        self.use_miles = use_miles
+
+    def emit(self, ctx):
+        dist = "{}['dist']".format(ctx.edge_properties())
+        return "{}({})".format(ctx.bind(meters_to_miles, "_f"), dist) if self.use_miles else dist
+
+
+class OpaqueValue(Value):
+    scope = STATE
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def emit(self, ctx):
+        return "{}(p)".format(ctx.bind(self.fn, "_f"))
+
+
+def as_expr(constraint):
+    return constraint if isinstance(constraint, Expr) else Opaque(constraint)
+
+
+def as_value(value_fn):
+    return value_fn if isinstance(value_fn, Value) else OpaqueValue(value_fn)
+
+
+def compile_constraint(expr, graph=None, hoisted=False):
+    """
+    Compiles an expression into one fused constraint function taking ConstraintParams.
+    :param graph: If given, checks that only depend on a single node are evaluated up front for every node in
+                  the graph and become set lookups.
+    :param hoisted: If True, leave out the top level checks that edge_filter(expr) moves into graph building.
+                    Only use this with a graph built with that edge filter. Checks nested in state dependent
+                    expressions stay: the per-depth category pairs of follows_cat_sequence, for example, are in
+                    the edge filter only as their union (an edge passes if it fits any depth), so each state
+                    still has to check the pair for its own depth.
+    :return:
+    """
+    expr = as_expr(expr).simplify()
+    if hoisted:
+        conjuncts = expr.conjuncts() if isinstance(expr, And) else [expr]
+        expr = And([c for c in conjuncts if c.scope > EDGE]).simplify()
+    ctx = _CompileContext(graph=graph)
+    source = "def fused_constraint(p):\n    return {}\n".format(expr.emit(ctx))
+    exec(compile(source, "<constraint>", "exec"), ctx.namespace)
+    fn = ctx.namespace['fused_constraint']
+    fn.source = source
+    return fn
+
+
+def edge_filter(expr):
+    """
+    Returns fn(node_a, node_b, edge_properties) that is true for every edge a neighbor constraint could accept,
+    built from the parts of the expression that only depend on the two nodes and the edge between them.
+    Pass it to build_entity_graph so those checks run once per edge instead of once per search state.
+    State dependent parts contribute what every one of their cases requires (see Expr.relax), which prunes edges
+    but doesn't replace the per-state check.
+    Returns None if nothing can be checked ahead of time.
+    """
+    expr = as_expr(expr).simplify()
+    conjuncts = expr.conjuncts() if isinstance(expr, And) else [expr]
+    # Checks that only read the edge move completely, anything else contributes whatever it requires of the edge
+    edge_expr = And([c if c.scope <= EDGE else c.relax() for c in conjuncts]).simplify()
+    if _is_const(edge_expr, True):
+        return None
+    ctx = _CompileContext(edge_mode=True)
+    source = "def fused_edge_filter(node_a, node_b, props):\n    return {}\n".format(edge_expr.emit(ctx))
+    exec(compile(source, "<edge filter>", "exec"), ctx.namespace)
+    fn = ctx.namespace['fused_edge_filter']
+    fn.source = source
+    return fn
+
+
+def state_key_fn(*exprs):
+    """
+    Returns a state key function for generate_plans (see algo.build_state_key_fn) that covers everything the
+    given neighbor / success expressions read, so states with equal keys can safely be merged.
+    Returns None if any of them wraps a plain function, since then there's no telling what it depends on.
+    """
+    attrs = _union_state_attrs([as_expr(e) for e in exprs])
+    if attrs is None:
+        return None
+    return build_state_key_fn(attrs)
+
+
+class BooleanExprs:
+    def __init__(self):
+        pass
+
+    def bool_and(self, constraints):
+        return And(constraints)
+
+    def bool_or(self, constraints):
+        return Or(constraints)
+
+    def bool_not(self, constraints):
+        return Not(constraints)
+
+    def bool_true(self):
+        return TRUE
+
+    def bool_false(self):
+        return FALSE
+
+    def bool_if_then_else(self, if_constraint, then_constraint, else_constraint):
+        return IfThenElse(if_constraint, then_constraint, else_constraint)
+
+    def bool_equals(self, curr_state_fn, next_state_fn):
+        return Compare("eq", curr_state_fn, next_state_fn)
+
+    def bool_gtr_than(self, curr_state_fn, next_state_fn):
+        return Compare("gt", curr_state_fn, next_state_fn)
+
+    def bool_less_than(self, curr_state_fn, next_state_fn):
+        return Compare("lt", curr_state_fn, next_state_fn)
+
+    def bool_boolean(self, bool_fn):
+        return as_expr(bool_fn)
+
+
+class EdgeExprs:
+    def __init__(self):
+        pass
+
+    def category_seq(self, valid_cats_A, valid_cats_B):
+        return CategorySeq(valid_cats_A, valid_cats_B)
+
+
+class StateExprs:
+    def __init__(self):
+        pass
+
+    def prev_state_dependent(self, constraint_dict, ignore_missing_keys=True, default=None):
+        return PrevStateDependent(constraint_dict, ignore_missing_keys, default)
+
+    def curr_state_category_in(self, cats):
+        return NodeCategoryIn(cats)
+
+    def no_repeat_visits(self):
+        return NoRepeatVisits()
+
+
+class UberExprs:
+    def __init__(self):
+        self._s = StateExprs()
+        self._e = EdgeExprs()
+
+    def follows_cat_sequence(self, category_sequence):
+        const_dict = {}
+        for i in range(len(category_sequence) - 1):
+            const_dict[i] = self._e.category_seq(category_sequence[i], category_sequence[i + 1])
+        # States past the end of the sequence can't be reached, so treat every other depth like the last one.
+        # This lets edge_filter move the category checks into graph building.
+        return self._s.prev_state_dependent(const_dict, default=FALSE)
+
+
+class StateExprExtractors:
+    def __init__(self):
+        pass
+
+    def get_categories(self, use_next=False):
+        return StateCategories(use_next)
+
+    def get_attr(self, attr_name, use_next=False):
+        return StateAttr(attr_name, use_next)
+
+    def const(self, value):
+        return ConstValue(value)
+
+
+class EdgeExprExtractors:
+    def __init__(self):
+        pass
+
+    def get_distance(self, use_miles=False):
+        return EdgeDistance(use_miles)
@@ -5,6 +5,7 @@ Executed on all edges from a particular state
 """
 
 from utils import meters_to_miles
+from categories import CategoryMasks
 
 
 class BooleanConstraints:
@@ -79,6 +80,8 @@ class EdgeConstraints:
         pass
 
     def category_seq(self, valid_cats_A, valid_cats_B):
+        masks_A = CategoryMasks(valid_cats_A) if valid_cats_A is not None else None
+        masks_B = CategoryMasks(valid_cats_B) if valid_cats_B is not None else None
         def cat_fn(constraint_params):
             curr_state = constraint_params.curr_state
             next_state = constraint_params.next_state
@@ -89,25 +92,19 @@ class EdgeConstraints:
             # Check for special case intersections:
             #   1) No required first category (doesn't matter where we come from)
             #   2) No required second category (doesn't matter where we go)
-            if valid_cats_A is None:
+            if masks_A is None:
                 curr_intersect = True
-            if valid_cats_B is None:
+            if masks_B is None:
                 next_intersect = True
 
             # If no exemption found, actually check for an intersection
             if not curr_intersect and curr_state is not None:
-                curr_intersect = len(set(valid_cats_A).intersection(curr_state.node.entity.categories)) > 0
+                node = curr_state.node
+                curr_intersect = (node.category_mask & masks_A[node.category_index]) != 0
             if not next_intersect:
-                next_intersect = len(set(valid_cats_B).intersection(next_state.node.entity.categories)) > 0
-
-            """
-            print("{} vs {} | {} ........ {} vs {} | {}".format(curr_state.node.entity.categories,
-                                                                valid_cats_A,
-                                                                curr_intersect,
-                                                                next_state.node.entity.categories,
-                                                                valid_cats_B,
-                                                                next_intersect))
-            """
+                node = next_state.node
+                next_intersect = (node.category_mask & masks_B[node.category_index]) != 0
+
             return curr_intersect and next_intersect
         return cat_fn
 
@@ -132,19 +129,16 @@ class StateConstraints:
         return prev_state_dependent_fn
 
     def curr_state_category_in(self, cats):
+        masks = CategoryMasks(cats)
         def curr_state_category_in_fn(constraint_params):
-            curr_state = constraint_params.curr_state
-            #print(curr_state.node.entity.categories)
-            if len(curr_state.node.entity.categories.intersection(cats)):
-                return True
-            return False
+            node = constraint_params.curr_state.node
+            return (node.category_mask & masks[node.category_index]) != 0
         return curr_state_category_in_fn
 
     def no_repeat_visits(self):
         def fn(constraint_params):
             next_state = constraint_params.next_state
-            prev = set([s.node.entity.id for s in next_state.prev_state_list()])
-            return next_state.node.entity.id not in prev
+            return next_state.prev_state is None or not next_state.prev_state.has_visited(next_state.node.entity.id)
         return fn
 
 class UberConstraints:
@@ -1,3 +1,5 @@
+import numpy as np
+
 class EdgeDoesNotExistException(Exception):
     def __init__(self, nodeA, nodeB):
 
@@ -9,7 +11,28 @@ class Graph:
     def __init__(self):
         self.nodes = set()
         self.edges = {}
+        # node -> set of nodes with an edge to it
+        self.reverse_edges = {}
         self.edge_properties = {}
+        # Optional timing.TimingTable of precomputed travel / dwell times
+        self.timing = None
+        # Lazy TimingTables made for searches with other functions, see algo.get_timing_table
+        self.timing_tables = {}
+
+    def __getstate__(self):
+        # Search timing tables are rebuilt on demand, and may hold functions that can't be pickled. self.timing is
+        # kept, since searches fall back to its functions, so it has to be built with picklable ones.
+        state = dict(self.__dict__)
+        state['timing_tables'] = {}
+        return state
+
+    def invalidate_timing(self, nodes):
+        """
+        Forgets the travel / dwell times of nodes in every TimingTable of the graph, after their edges changed.
+        """
+        for timing in [self.timing] + list(self.timing_tables.values()):
+            if timing is not None:
+                timing.invalidate(nodes)
 
     def get_edges(self, node):
         return self.edges.get(node, [])
@@ -20,6 +43,9 @@ class Graph:
         except KeyError:
             raise EdgeDoesNotExistException(node1, node2)
 
+    def get_predecessors(self, node):
+        return self.reverse_edges.get(node, set())
+
     def add_node(self, node):
         self.nodes.add(node)
 
@@ -29,8 +55,31 @@ class Graph:
         if node1 not in self.edges:
             self.edges[node1] = set()
         self.edges[node1].add(node2)
+        if node2 not in self.reverse_edges:
+            self.reverse_edges[node2] = set()
+        self.reverse_edges[node2].add(node1)
         self.edge_properties[(node1, node2)] = properties
 
+    def remove_edge(self, node1, node2):
+        try:
+            del self.edge_properties[(node1, node2)]
+        except KeyError:
+            raise EdgeDoesNotExistException(node1, node2)
+        self.edges[node1].discard(node2)
+        self.reverse_edges[node2].discard(node1)
+
+    def remove_node(self, node):
+        """
+        Removes the node and every edge to or from it.
+        """
+        for node2 in self.edges.pop(node, set()):
+            self.reverse_edges[node2].discard(node)
+            del self.edge_properties[(node, node2)]
+        for node1 in self.reverse_edges.pop(node, set()):
+            self.edges[node1].discard(node)
+            del self.edge_properties[(node1, node)]
+        self.nodes.discard(node)
+
     """
     Automatically construct the graph connecting nodes when edge_condition_fn is satisfied
     and assigning properties via edge_properties_fn
@@ -41,3 +90,97 @@ class Graph:
                 if nodeA != nodeB:
                     if edge_condition_fn(nodeA, nodeB):
                         self.add_edge(nodeA, nodeB, edge_properties_fn(nodeA, nodeB))
+
+
+class CSRGraph:
+    """
+    Read-only graph stored in compressed sparse row form. Nodes get integer ids (their position in
+    self.nodes), the out-edges of node i are neighbors[offsets[i]:offsets[i + 1]] (sorted by id),
+    and each numeric edge property is a float array parallel to neighbors.
+    Supports the same get_edges / get_edge_properties API as Graph.
+    """
+    def __init__(self, nodes, offsets, neighbors, edge_attrs):
+        self.nodes = list(nodes)
+        self.node_ids = {node: i for i, node in enumerate(self.nodes)}
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.edge_attrs = edge_attrs
+        # Optional timing.TimingTable of precomputed travel / dwell times
+        self.timing = None
+        # Lazy TimingTables made for searches with other functions, see algo.get_timing_table
+        self.timing_tables = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['timing_tables'] = {}
+        return state
+
+    @classmethod
+    def from_edges(cls, nodes, rows, cols, edge_attrs):
+        """
+        Builds a CSRGraph from parallel arrays of edges.
+        :param nodes: The list of nodes. Node ids are positions in this list.
+        :param rows: Source node id of each edge.
+        :param cols: Destination node id of each edge.
+        :param edge_attrs: Dict mapping property name to an array of values, one per edge.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        order = np.lexsort((cols, rows))
+        offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(nodes)), out=offsets[1:])
+        return cls(nodes,
+                   offsets,
+                   cols[order].astype(np.int32),
+                   {name: np.asarray(values, dtype=np.float64)[order] for name, values in edge_attrs.items()})
+
+    @classmethod
+    def from_graph(cls, graph):
+        """
+        Builds a CSRGraph from a Graph. All edge properties must be numeric.
+        """
+        nodes = list(graph.nodes)
+        node_ids = {node: i for i, node in enumerate(nodes)}
+        # Always with a distance column, which searches read even when there are no edges
+        attr_names = sorted(set(name for props in graph.edge_properties.values() for name in props) | {"dist"})
+        rows, cols = [], []
+        attrs = {name: [] for name in attr_names}
+        for (node1, node2), properties in graph.edge_properties.items():
+            rows.append(node_ids[node1])
+            cols.append(node_ids[node2])
+            for name in attr_names:
+                attrs[name].append(properties.get(name, np.nan))
+        return cls.from_edges(nodes, rows, cols, attrs)
+
+    def num_edges(self):
+        return len(self.neighbors)
+
+    def get_edge_range(self, node_id):
+        """
+        Returns the (start, end) slice of neighbors / edge_attrs holding the out-edges of node_id.
+        """
+        return int(self.offsets[node_id]), int(self.offsets[node_id + 1])
+
+    def get_edge_index(self, node1, node2):
+        try:
+            node_id1, node_id2 = self.node_ids[node1], self.node_ids[node2]
+        except KeyError:
+            raise EdgeDoesNotExistException(node1, node2)
+        # Each row's neighbors are sorted, so binary search the row for node2
+        start, end = self.get_edge_range(node_id1)
+        idx = start + int(np.searchsorted(self.neighbors[start:end], node_id2))
+        if idx >= end or self.neighbors[idx] != node_id2:
+            raise EdgeDoesNotExistException(node1, node2)
+        return idx
+
+    def get_edges(self, node):
+        node_id = self.node_ids.get(node)
+        if node_id is None:
+            return []
+        start, end = self.get_edge_range(node_id)
+        nodes = self.nodes
+        return [nodes[j] for j in self.neighbors[start:end].tolist()]
+
+    def get_edge_properties(self, node1, node2):
+        idx = self.get_edge_index(node1, node2)
+        return {name: values[idx].item() for name, values in self.edge_attrs.items()}
@@ -0,0 +1,103 @@
+"""
+Opening hours compiled into sorted minute-of-week intervals for fast "is it open" checks.
+Minute 0 of the week is midnight at the start of Monday (matching datetime.weekday()).
+"""
+from bisect import bisect_right
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+def minute_of_week(dt):
+    """
+    Returns the (possibly fractional) number of minutes since the start of the week dt is in.
+    """
+    return (dt.weekday() * MINUTES_PER_DAY + dt.hour * 60 + dt.minute
+            + (dt.second + dt.microsecond / 1e6) / 60)
+
+
+def _time_to_minutes(tm):
+    return tm.hour * 60 + tm.minute
+
+
+class HoursIndex:
+    """
+    Weekly opening hours as a sorted list of disjoint, inclusive [start, end] minute intervals.
+    Overnight spans run into the next day (Sunday night runs into Monday morning), as do spans that
+    end before they start even if they're not marked is_overnight (e.g. 18:00-00:00 closes at
+    midnight). Spans that touch or overlap are merged so "open for the whole interval" is a single
+    lookup.
+    """
+    def __init__(self, hours):
+        """
+        :param hours: Business hours in the format produced by YelpAPI: one list per weekday of
+                      {"start": time, "end": time, "is_overnight": bool} dicts.
+        """
+        spans = []
+        for day, day_hours in enumerate(hours):
+            for hrs in day_hours:
+                start = day * MINUTES_PER_DAY + _time_to_minutes(hrs['start'])
+                end = day * MINUTES_PER_DAY + _time_to_minutes(hrs['end'])
+                if hrs['is_overnight'] or end < start:
+                    end += MINUTES_PER_DAY
+                spans.append((start, end))
+
+        # Repeat the week before and after so spans wrapping around the end of the week, and
+        # queries running past it, don't need special handling.
+        tiled = sorted((start + shift, end + shift)
+                       for shift in (-MINUTES_PER_WEEK, 0, MINUTES_PER_WEEK)
+                       for start, end in spans)
+        self.starts = []
+        self.ends = []
+        for start, end in tiled:
+            if len(self.ends) > 0 and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    @classmethod
+    def from_intervals(cls, starts, ends):
+        """
+        Builds an index straight from the starts / ends lists of an existing one (e.g. a saved graph snapshot).
+        """
+        index = cls.__new__(cls)
+        index.starts = starts
+        index.ends = ends
+        return index
+
+    def _interval_at(self, minute):
+        """
+        Returns the index of the interval containing minute, or -1 if closed.
+        """
+        i = bisect_right(self.starts, minute) - 1
+        if i >= 0 and minute <= self.ends[i]:
+            return i
+        return -1
+
+    def open_at_minute(self, minute):
+        # Same as _interval_at, inlined since searches call this for every candidate state
+        minute %= MINUTES_PER_WEEK
+        i = bisect_right(self.starts, minute) - 1
+        return i >= 0 and minute <= self.ends[i]
+
+    def open_between_minutes(self, start_minute, end_minute):
+        """
+        True if open for the whole span from start_minute to end_minute (minutes of the week,
+        end_minute may run past the end of the week).
+        """
+        offset = start_minute - start_minute % MINUTES_PER_WEEK
+        i = self._interval_at(start_minute - offset)
+        return i >= 0 and end_minute - offset <= self.ends[i]
+
+    def open_at(self, dt):
+        # Interval ends are whole minutes, so any time past the start of a minute compares the same
+        minute = dt.weekday() * MINUTES_PER_DAY + dt.hour * 60 + dt.minute
+        if dt.second or dt.microsecond:
+            minute += 0.5
+        i = bisect_right(self.starts, minute) - 1
+        return i >= 0 and minute <= self.ends[i]
+
+    def open_between(self, start_dt, end_dt):
+        start_minute = minute_of_week(start_dt)
+        return self.open_between_minutes(start_minute, start_minute + (end_dt - start_dt).total_seconds() / 60)
@@ -0,0 +1,186 @@
+"""
+Layered search for category-sequence plans (the ones UberConstraints.follows_cat_sequence describes).
+
+Plan i's stop has to come from category_sequence[i], so the plans form a fixed number of layers: layer i holds
+the nodes in category_sequence[i]. Instead of a generic search re-checking the category constraint on every
+edge, LayeredSearch works out each layer's candidate nodes (and each node's edges into the next layer) once, then
+runs a forward DP over (layer, node, time): every state in a layer is expanded once per distinct (node, end
+time), and the other states reaching it become its merged_states, the same way iter_plans merges states with a
+state_key_fn. The final layer's states stand for every plan, which plan.iter_plan_paths lists and
+plan.plan_count counts.
+
+With no_repeat_visits, states also have to agree on which of the places they visited could come up again in a
+later layer. If the layers don't share any places that's nothing, and the DP is over (layer, node, time) alone.
+"""
+from algo import PlanState, get_timing_table, open_visits
+from categories import CategoryMasks
+from timing import Timeline
+
+_NO_IDS = frozenset()
+
+
+def category_candidates(nodes, categories):
+    """
+    Returns the nodes in any of the categories (all of them if categories is None), in order.
+    """
+    nodes = list(nodes)
+    if categories is None:
+        return nodes
+    masks = CategoryMasks(categories)
+    return [node for node in nodes if (node.category_mask & masks[node.category_index]) != 0]
+
+
+class LayeredSearch:
+    """
+    Finds the plans that visit a place from each entry of category_sequence in order, on graph. Produces the
+    same plans as plan.generate_plans with shortcuts.category_sequence_search_fns and initial states from
+    algo.build_initial_states with curr_state_category_in(category_sequence[0]).
+
+        search = LayeredSearch(graph, [["coffee"], ["museums"], ["bars"]])
+        final_states = search.run(start_dts)
+        num_plans = plan_count(final_states)
+
+    The layer candidates and edges are kept between runs, so one LayeredSearch can serve many start times. They
+    aren't updated by EntityGraphBuilder.add_entity / remove_entity, so make a new one after changing the graph.
+    """
+    def __init__(self, graph, category_sequence, no_repeat_visits=True, time_spent_fn=None, distance_time_fn=None,
+                 require_open_throughout=False):
+        """
+        :param category_sequence: One list of category aliases per stop. None for a stop that can be anything.
+        :param time_spent_fn: See algo.build_neighbor_state_fn.
+        :param distance_time_fn: See algo.build_neighbor_state_fn.
+        :param require_open_throughout: See algo.build_neighbor_state_fn.
+        """
+        if len(category_sequence) == 0:
+            raise ValueError("category_sequence must have at least one entry")
+        self.graph = graph
+        self.category_sequence = list(category_sequence)
+        self.no_repeat_visits = no_repeat_visits
+        self.require_open_throughout = require_open_throughout
+        self.timing = get_timing_table(graph, time_spent_fn, distance_time_fn)
+        self.candidates = [category_candidates(graph.nodes, categories) for categories in self.category_sequence]
+        self._candidate_sets = [set(nodes) for nodes in self.candidates]
+        # Ids of the places that could be visited after each layer. A state only has to remember which of these
+        # it already visited.
+        self._later_ids = [None] * len(self.candidates)
+        later_ids = set()
+        for i in range(len(self.candidates) - 1, -1, -1):
+            self._later_ids[i] = frozenset(later_ids) if no_repeat_visits else _NO_IDS
+            later_ids.update(node.entity.id for node in self.candidates[i])
+        # Per layer, node -> its (next node, travel minutes) edges into the next layer
+        self._layer_edges = [{} for _ in self.candidates]
+        # States of each layer from the last run, by (node, end, visited ids that matter later)
+        self.layers = []
+
+    def _edges_to_next_layer(self, layer, node):
+        edges = self._layer_edges[layer].get(node)
+        if edges is None:
+            next_candidates = self._candidate_sets[layer + 1]
+            edges = tuple(edge for edge in self.timing.out_edges(node) if edge[0] in next_candidates)
+            self._layer_edges[layer][node] = edges
+        return edges
+
+    def _first_layer(self, possible_starts, timeline, stats):
+        timing = self.timing
+        require_open_throughout = self.require_open_throughout
+        later_ids = self._later_ids[0]
+        states = {}
+        for node in self.candidates[0]:
+            entity_id = node.entity.id
+            visited = frozenset((entity_id,)) if entity_id in later_ids else _NO_IDS
+            # Starting somewhere is arriving there after no travel
+            here = ((node, 0),)
+            for possible_start in possible_starts:
+                for _, start, end in open_visits(here, possible_start, timing, timeline, require_open_throughout,
+                                                 stats):
+                    state = PlanState(node, start, end, None, 0, timeline)
+                    key = (node, end, visited)
+                    representative = states.get(key)
+                    if representative is None:
+                        states[key] = state
+                    else:
+                        representative.add_merged_state(state)
+        return states
+
+    def run(self, possible_start_dts, timeline=None, stats=None):
+        """
+        Returns the final states, one per distinct (last place, end time), each standing for every plan through
+        its merged states. Also kept in self.layers[-1] along with the states of the earlier layers.
+        :param possible_start_dts: The possible start times.
+        :param timeline: See algo.build_initial_states.
+        :param stats: Optional stats.SearchStats. States are counted as popped when they're expanded, and repeat
+                      visits are counted as rejected by the constraint.
+        """
+        if len(possible_start_dts) == 0:
+            self.layers = []
+            return []
+        if timeline is None:
+            timeline = Timeline(min(possible_start_dts))
+        possible_starts = [timeline.to_minute(start_dt) for start_dt in possible_start_dts]
+        if stats is not None:
+            stats.start()
+        timing = self.timing
+        require_open_throughout = self.require_open_throughout
+        expanded = repeats = generated = 0
+
+        layer_states = self._first_layer(possible_starts, timeline, stats)
+        self.layers = [layer_states]
+        for layer in range(len(self.candidates) - 1):
+            later_ids = self._later_ids[layer + 1]
+            num_prev_states = layer + 1
+            next_states = {}
+            for (node, end, visited), state in layer_states.items():
+                expanded += 1
+                edges = self._edges_to_next_layer(layer, node)
+                if visited:
+                    num_edges = len(edges)
+                    edges = [edge for edge in edges if edge[0].entity.id not in visited]
+                    repeats += num_edges - len(edges)
+                last_node = next_visited = None
+                for next_node, next_start, next_end in open_visits(edges, end, timing, timeline,
+                                                                   require_open_throughout, stats):
+                    if next_node is not last_node:
+                        # Visits come grouped by node, so this is once per node
+                        last_node = next_node
+                        next_id = next_node.entity.id
+                        if not later_ids:
+                            next_visited = _NO_IDS
+                        else:
+                            next_visited = frozenset(entity_id for entity_id in visited if entity_id in later_ids)
+                            if next_id in later_ids:
+                                next_visited |= {next_id}
+                    next_state = PlanState(next_node, next_start, next_end, state, num_prev_states, timeline)
+                    key = (next_node, next_end, next_visited)
+                    representative = next_states.get(key)
+                    if representative is None:
+                        next_states[key] = next_state
+                        generated += 1
+                    else:
+                        representative.add_merged_state(next_state)
+            layer_states = next_states
+            self.layers.append(layer_states)
+            if stats is not None:
+                stats.sample_frontier(len(layer_states))
+
+        final_states = list(layer_states.values())
+        if stats is not None:
+            # Final states aren't expanded, they're popped only to be handed back
+            stats.states_popped += expanded + len(final_states)
+            stats.success_states += len(final_states)
+            stats.rejected_by_constraint += repeats
+            stats.neighbors_generated += generated
+            stats.finish()
+        return final_states
+
+
+def generate_sequence_plans(graph, category_sequence, possible_start_dts, no_repeat_visits=True, time_spent_fn=None,
+                            distance_time_fn=None, require_open_throughout=False, timeline=None, stats=None):
+    """
+    One-off LayeredSearch. Returns the final states as a set, like plan.generate_plans with a state_key_fn.
+    """
+    search = LayeredSearch(graph, category_sequence,
+                           no_repeat_visits=no_repeat_visits,
+                           time_spent_fn=time_spent_fn,
+                           distance_time_fn=distance_time_fn,
+                           require_open_throughout=require_open_throughout)
+    return set(search.run(possible_start_dts, timeline=timeline, stats=stats))
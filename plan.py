@@ -1,5 +1,10 @@
 import copy
-from algo import ConstraintParams
+import heapq
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from algo import ConstraintParams, PlanState
 
 def default_neighbor_state_fn(constraint_params):
     graph = constraint_params.graph
@@ -19,25 +24,271 @@ def default_is_success_state_fn(constraint_params):
 """
 Outputs a list of successful terminal states.
 """
-def generate_plans(graph, initial_states, neighbor_state_fn, success_state_fn, process_state_fn):
+def generate_plans(graph, initial_states, neighbor_state_fn, success_state_fn, process_state_fn,
+                   max_results=None, timeout=None, state_key_fn=None, stats=None):
+    return set(iter_plans(graph, initial_states, neighbor_state_fn, success_state_fn, process_state_fn,
+                          max_results=max_results, timeout=timeout, state_key_fn=state_key_fn, stats=stats))
+
+def _merge_equivalent_states(states, state_key_fn, representatives):
+    """
+    Returns the states whose key hasn't been seen before. The rest are recorded on the state they're
+    equivalent to instead of being searched again.
+    """
+    unmerged = []
+    for state in states:
+        key = state_key_fn(state)
+        representative = representatives.get(key)
+        if representative is None:
+            representatives[key] = state
+            unmerged.append(state)
+        else:
+            representative.add_merged_state(state)
+    return unmerged
+
+def iter_plans(graph, initial_states, neighbor_state_fn, success_state_fn, process_state_fn=None,
+               max_results=None, timeout=None, state_key_fn=None, stats=None):
+    """
+    Streaming version of generate_plans. Yields successful terminal states as soon as they're found
+    instead of collecting them all first. The search stops as soon as the caller stops iterating.
+    :param max_results: Stop the search after yielding this many states.
+    :param timeout: Stop the search after this many seconds (wall clock).
+    :param state_key_fn: Optional fn(state) returning a key that's equal for states the rest of the search can't
+                         tell apart (see algo.build_state_key_fn and constraint_expr.state_key_fn). Only the
+                         first state with a given key is searched, later ones are added to its merged_states.
+                         The yielded states then stand for every plan through their merged states, which
+                         iter_plan_paths and plan_count enumerate (once the search is done).
+    :param stats: Optional stats.SearchStats to count states popped and successes in and sample the queue size
+                  into. Pass the same one to build_neighbor_state_fn for the rest of the counters.
+    :return:
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    num_results = 0
+    if max_results is not None and max_results <= 0:
+        return
     global_memory = {}
+    # Key -> the state searched for it, when merging equivalent states
+    representatives = {} if state_key_fn is not None else None
     queue = copy.copy(initial_states)
-    success_states = set()
-    while len(queue) > 0:
-        state = queue.pop()
-        # print("Popping {0}".format(state.node.entity.name))
-        # Process state (make any edits to global memory if needed)
-        # process_state_fn(graph, state, global_memory)
+    if representatives is not None:
+        queue = _merge_equivalent_states(queue, state_key_fn, representatives)
+    if stats is not None:
+        stats.start()
+    try:
+        while len(queue) > 0:
+            if deadline is not None and time.monotonic() > deadline:
+                return
+            state = queue.pop()
+            # print("Popping {0}".format(state.node.entity.name))
+            # Process state (make any edits to global memory if needed)
+            # process_state_fn(graph, state, global_memory)
+            if stats is not None:
+                stats.states_popped += 1
+                if stats.states_popped % stats.sample_interval == 0:
+                    stats.sample_frontier(len(queue))
 
-        constraint_params = ConstraintParams(graph, state, None, global_memory)
+            constraint_params = ConstraintParams(graph, state, None, global_memory)
+
+            # Check if successful final state. If so, hand it back right away.
+            if success_state_fn(constraint_params):
+                if stats is not None:
+                    stats.success_states += 1
+                yield state
+                num_results += 1
+                if max_results is not None and num_results >= max_results:
+                    return
+
+            # Get state neighbors and add to queue
+            neighbors = neighbor_state_fn(constraint_params)
+            #print("\tFound {} neighbors".format(len(neighbors)))
+            if representatives is not None:
+                neighbors = _merge_equivalent_states(neighbors, state_key_fn, representatives)
+            queue.extend(neighbors)
+    finally:
+        if stats is not None:
+            stats.finish()
+
+def _iter_paths_to(state):
+    for alternative in [state] + (state.merged_states or []):
+        if alternative.prev_state is None:
+            yield [alternative]
+        else:
+            for path in _iter_paths_to(alternative.prev_state):
+                path.append(alternative)
+                yield path
+
+def iter_plan_paths(final_state):
+    """
+    Yields every plan (list of states, first to last) ending in final_state. Without merged states (see
+    iter_plans' state_key_fn) that's just the one plan, prev_state_list() + [final_state]. Each merged state
+    along the way is an alternative for the states before that point.
+    """
+    for path in _iter_paths_to(final_state):
+        yield path
+
+def plan_count(final_states):
+    """
+    Returns the number of plans the final states stand for, counting every alternative through merged states
+    without listing them.
+    :param final_states: A success state or an iterable of them.
+    """
+    if isinstance(final_states, PlanState):
+        final_states = [final_states]
+    # Number of distinct plans up to and including each state, by id
+    counts = {}
+    def count_paths_to(state):
+        count = counts.get(id(state))
+        if count is None:
+            count = 0
+            for alternative in [state] + (state.merged_states or []):
+                count += 1 if alternative.prev_state is None else count_paths_to(alternative.prev_state)
+            counts[id(state)] = count
+        return count
+    return sum(count_paths_to(state) for state in final_states)
+
+def top_k_plans(graph, initial_states, neighbor_state_fn, success_state_fn, score_fn, k,
+                bound_fn=None, timeout=None):
+    """
+    Best-first search for the k success states with the lowest score, instead of enumerating every plan and
+    sorting them.
+    :param score_fn: fn(graph, state) scoring a success state. Lower is better
+                     (e.g. shortcuts.plan_total_distance).
+    :param k: Number of plans to return.
+    :param bound_fn: Optional fn(graph, state) returning a lower bound on the score of the state (if it's a
+                     success state) and every state reachable from it (e.g. shortcuts.plan_distance_so_far for
+                     distance). States are explored in order of their bound, partial plans whose bound can't
+                     beat the current k-th best are pruned, and the search ends once no queued state can.
+                     Without it every plan is explored (depth first), keeping only the best k.
+    :param timeout: Stop the search after this many seconds (wall clock) and return the best found so far.
+    :return: The best success states, best first.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    global_memory = {}
+    # Ties are broken by insertion order, newest first, so the search stays depth first.
+    counter = 0
+    queue = []
+    for state in initial_states:
+        counter += 1
+        heapq.heappush(queue, (bound_fn(graph, state) if bound_fn is not None else 0, -counter, state))
+    # Max-heap (by negated score) of the best success states found so far. Tied scores are broken by the order
+    # they were found in, earliest first, and never fall through to comparing the states.
+    best = []
+    num_found = 0
 
-        # Check if successful final state. If so, add it to successful plan states.
+    while len(queue) > 0 and k > 0:
+        if deadline is not None and time.monotonic() > deadline:
+            break
+        bound, _, state = heapq.heappop(queue)
+        if len(best) == k and bound_fn is not None and bound >= -best[0][0]:
+            # Everything left in the queue has a bound at least this large
+            break
+
+        constraint_params = ConstraintParams(graph, state, None, global_memory)
         if success_state_fn(constraint_params):
-            success_states.add(state)
+            score = score_fn(graph, state)
+            num_found += 1
+            if len(best) < k:
+                heapq.heappush(best, (-score, -num_found, state))
+            elif score < -best[0][0]:
+                heapq.heapreplace(best, (-score, -num_found, state))
+
+        for neighbor in neighbor_state_fn(constraint_params):
+            counter += 1
+            neighbor_bound = bound_fn(graph, neighbor) if bound_fn is not None else 0
+            if len(best) == k and bound_fn is not None and neighbor_bound >= -best[0][0]:
+                continue
+            heapq.heappush(queue, (neighbor_bound, -counter, neighbor))
+
+    return [state for _, _, state in sorted(best, key=lambda x: (-x[0], -x[1]))]
+
+
+# Per-process state for generate_plans_parallel workers, set up once by _init_parallel_worker
+_worker_context = {}
+
+def _init_parallel_worker(payload, search_fns_factory, factory_args):
+    graph, nodes, initial_states = pickle.loads(payload)
+    neighbor_state_fn, success_state_fn = search_fns_factory(*factory_args)
+    _worker_context.update(graph=graph,
+                           node_ids={node: i for i, node in enumerate(nodes)},
+                           initial_states=initial_states,
+                           neighbor_state_fn=neighbor_state_fn,
+                           success_state_fn=success_state_fn)
+
+def _run_parallel_chunk(initial_state_idxs, max_results, deadline):
+    ctx = _worker_context
+    # The deadline is on the parent's time.monotonic() clock, which is system wide, so it's the same here
+    timeout = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+    node_ids = ctx['node_ids']
+    initial_state_ids = {id(ctx['initial_states'][i]): i for i in initial_state_idxs}
+    results = []
+    for state in iter_plans(ctx['graph'],
+                            [ctx['initial_states'][i] for i in initial_state_idxs],
+                            ctx['neighbor_state_fn'],
+                            ctx['success_state_fn'],
+                            max_results=max_results,
+                            timeout=timeout):
+        # Send back node ids and times rather than the states themselves, which would drag copies of the
+        # entities along with them.
+        states = state.prev_state_list() + [state]
+        results.append((initial_state_ids[id(states[0])],
+                        [(node_ids[s.node], s.start, s.end) for s in states[1:]]))
+    return results
+
+def generate_plans_parallel(graph, initial_states, search_fns_factory, factory_args=(), num_workers=None,
+                            chunks_per_worker=4, max_results=None, timeout=None):
+    """
+    Runs generate_plans on a process pool. The initial states are split across workers (the subtrees under
+    each one are independent) and the results are merged.
+    Constraints are closures and can't be pickled, so each worker builds its own by calling
+    search_fns_factory(*factory_args), which must be a module-level function
+    (e.g. shortcuts.category_sequence_search_fns). The graph is pickled too, so if it has a graph.timing, the
+    time_spent_fn / distance_time_fn it was built with must be module level as well.
+    :param search_fns_factory: Returns a (neighbor_state_fn, success_state_fn) tuple.
+    :param num_workers: Number of worker processes (defaults to the number of CPUs).
+    :param chunks_per_worker: How many pieces to split each worker's share of initial states into, so
+                              workers that finish early can pick up more work.
+    :param max_results: Stop once this many plans have been found.
+    :param timeout: Stop searching after this many seconds (wall clock) from the call, across all workers.
+    :return: A set of success states built on the given graph and initial states.
+    """
+    # One deadline for every chunk, so chunks picked up late don't each get the whole timeout again
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    # The graph is sent to each worker once, together with the initial states so they share nodes.
+    nodes = list(graph.nodes)
+    payload = pickle.dumps((graph, nodes, initial_states), protocol=pickle.HIGHEST_PROTOCOL)
+    success_states = set()
+    if len(initial_states) == 0:
+        return success_states
 
-        # Get state neighbors and add to queue
-        neighbors = neighbor_state_fn(constraint_params)
-        #print("\tFound {} neighbors".format(len(neighbors)))
-        queue.extend(neighbors)
+    num_workers = num_workers if num_workers is not None else os.cpu_count()
+    num_chunks = min(len(initial_states), num_workers * chunks_per_worker)
+    with ProcessPoolExecutor(max_workers=num_workers,
+                             initializer=_init_parallel_worker,
+                             initargs=(payload, search_fns_factory, factory_args)) as executor:
+        futures = [executor.submit(_run_parallel_chunk,
+                                   list(range(chunk, len(initial_states), num_chunks)),
+                                   max_results,
+                                   deadline)
+                   for chunk in range(num_chunks)]
 
+        # Rebuild the plans from the parent's own nodes, sharing common prefixes like the serial search does
+        built_states = {}
+        for future in as_completed(futures):
+            for initial_state_idx, path in future.result():
+                state = initial_states[initial_state_idx]
+                key = (initial_state_idx,)
+                for node_id, start, end in path:
+                    key += ((node_id, start, end),)
+                    next_state = built_states.get(key)
+                    if next_state is None:
+                        next_state = PlanState(nodes[node_id], start, end, state, state.num_prev_states + 1,
+                                               state.timeline)
+                        built_states[key] = next_state
+                    state = next_state
+                success_states.add(state)
+                if max_results is not None and len(success_states) >= max_results:
+                    break
+            if max_results is not None and len(success_states) >= max_results:
+                for f in futures:
+                    f.cancel()
+                break
     return success_states
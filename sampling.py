@@ -0,0 +1,218 @@
+"""
+Counting plans and drawing random ones without listing them all.
+
+Final states with merged states (from layered.LayeredSearch, or plan.iter_plans with a state_key_fn) form a DAG
+in which every plan is one path. PlanSampler memoizes, per state, the number (or total weight) of the plans up to
+it, then draws a plan by walking back from a final state, picking among each state's alternatives in proportion
+to those counts. That's exact and uniform (or weighted) over every plan, at the cost of one pass over the DAG
+rather than one PlanState per plan.
+
+SequencePlanSpace does this for category-sequence requests, optionally on the smaller DAG that ignores repeat
+visits, in which case plans that repeat a place are rejected and the count becomes an estimate with bounds.
+"""
+import bisect
+import random
+from statistics import NormalDist
+
+from layered import LayeredSearch
+
+
+class NoPlansException(Exception):
+    def __init__(self):
+        message = "There are no plans to sample from"
+        super(Exception, self).__init__(message)
+
+
+class PlanSampler:
+    """
+    Draws plans (lists of states, first to last) at random from final states and their merged states.
+    Without a weight_fn every plan is equally likely and total is the exact number of plans (plan.plan_count).
+    """
+    def __init__(self, final_states, weight_fn=None, rng=None):
+        """
+        :param final_states: The final states the plans end in.
+        :param weight_fn: Optional fn(state) returning a non-negative weight for each stop. A plan's weight is the
+                          product over its states, and plans are drawn in proportion to it (e.g. favoring better
+                          rated places).
+        :param rng: random.Random to draw with. Defaults to a new unseeded one.
+        """
+        self.final_states = list(final_states)
+        self.weight_fn = weight_fn
+        self.rng = rng if rng is not None else random.Random()
+        # State id -> (its alternatives, cumulative weights of the plans through each)
+        self._choices = {}
+        self._final_cumulative = []
+        total = 0
+        for state in self.final_states:
+            total += self._choices_for(state)[1][-1]
+            self._final_cumulative.append(total)
+        self.total = total
+
+    def _state_weight(self, state):
+        # Total weight of the plans ending with this exact state
+        weight = self.weight_fn(state) if self.weight_fn is not None else 1
+        if state.prev_state is not None:
+            weight *= self._choices_for(state.prev_state)[1][-1]
+        return weight
+
+    def _choices_for(self, state):
+        choices = self._choices.get(id(state))
+        if choices is None:
+            alternatives = [state] + (state.merged_states or [])
+            cumulative = []
+            total = 0
+            for alternative in alternatives:
+                total += self._state_weight(alternative)
+                cumulative.append(total)
+            choices = (alternatives, cumulative)
+            self._choices[id(state)] = choices
+        return choices
+
+    def _draw(self, cumulative):
+        total = cumulative[-1]
+        # Integer weights (always the case without a weight_fn) are drawn exactly, however large the counts get
+        r = self.rng.randrange(total) if isinstance(total, int) else self.rng.random() * total
+        return min(bisect.bisect_right(cumulative, r), len(cumulative) - 1)
+
+    def sample(self):
+        """
+        Returns one plan as a list of states, first to last.
+        """
+        if not self.total:
+            raise NoPlansException()
+        state = self.final_states[self._draw(self._final_cumulative)]
+        path = []
+        while state is not None:
+            alternatives, cumulative = self._choices_for(state)
+            chosen = alternatives[self._draw(cumulative)]
+            path.append(chosen)
+            state = chosen.prev_state
+        path.reverse()
+        return path
+
+
+class PlanCountEstimate:
+    """
+    A plan count with bounds. When exact, count == lower == upper. Otherwise count is estimated from
+    num_samples plans drawn from an upper bound, num_accepted of which were valid, and lower / upper bound it
+    with the requested confidence.
+    """
+    def __init__(self, count, lower, upper, exact, num_samples=0, num_accepted=0):
+        self.count = count
+        self.lower = lower
+        self.upper = upper
+        self.exact = exact
+        self.num_samples = num_samples
+        self.num_accepted = num_accepted
+
+    def __repr__(self):
+        return "PlanCountEstimate(count={}, lower={}, upper={}, exact={})".format(self.count, self.lower,
+                                                                                  self.upper, self.exact)
+
+
+def _has_repeat_visit(path):
+    entity_ids = [state.node.entity.id for state in path]
+    return len(set(entity_ids)) != len(entity_ids)
+
+
+class SequencePlanSpace:
+    """
+    The plans visiting a place from each entry of category_sequence in order (see layered.LayeredSearch), counted
+    and sampled without being listed.
+
+        space = SequencePlanSpace(graph, [["coffee"], ["museums"], ["bars"]], start_dts, seed=0)
+        space.count()
+        suggestions = space.sample(5, distinct=True)
+
+    With no_repeat_visits and exact=False, the search ignores repeat visits (when layers share places, states
+    then don't have to remember which of them were visited, so there are fewer). count() is then an upper bound,
+    estimate_count() estimates the real count from the share of sampled plans without repeats, and sample()
+    rejects plans with repeats, which leaves the rest uniform (or weighted) among the valid plans.
+    """
+    def __init__(self, graph, category_sequence, possible_start_dts, no_repeat_visits=True, exact=True,
+                 time_spent_fn=None, distance_time_fn=None, require_open_throughout=False, timeline=None,
+                 seed=None):
+        """
+        :param seed: Seed for the random draws, for repeatable samples.
+        See LayeredSearch and LayeredSearch.run for the rest.
+        """
+        self.rejects_repeat_visits = no_repeat_visits and not exact
+        self.search = LayeredSearch(graph, category_sequence,
+                                    no_repeat_visits=no_repeat_visits and exact,
+                                    time_spent_fn=time_spent_fn,
+                                    distance_time_fn=distance_time_fn,
+                                    require_open_throughout=require_open_throughout)
+        self.final_states = self.search.run(possible_start_dts, timeline=timeline)
+        self.rng = random.Random(seed)
+        self._uniform_sampler = PlanSampler(self.final_states, rng=self.rng)
+        # The sampler for the last weight_fn given to sample()
+        self._weighted_sampler = None
+
+    def count(self):
+        """
+        Returns the number of plans. When repeat visits are rejected rather than ruled out in the search, this
+        counts the plans with repeats too, so it's an upper bound (see estimate_count).
+        """
+        return self._uniform_sampler.total
+
+    def estimate_count(self, num_samples=1000, confidence=0.95):
+        """
+        Returns a PlanCountEstimate. It's exact unless repeat visits are rejected, in which case num_samples plans
+        are drawn uniformly and the bounds are the Wilson score interval for the share without repeats.
+        """
+        total = self.count()
+        if not self.rejects_repeat_visits or total == 0:
+            return PlanCountEstimate(total, total, total, True)
+        sampler = self._uniform_sampler
+        accepted = set()
+        num_accepted = 0
+        for _ in range(num_samples):
+            path = sampler.sample()
+            if not _has_repeat_visit(path):
+                num_accepted += 1
+                accepted.add(tuple(id(state) for state in path))
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        share = num_accepted / num_samples
+        center = (share + z * z / (2 * num_samples)) / (1 + z * z / num_samples)
+        half_width = (z / (1 + z * z / num_samples)) * (share * (1 - share) / num_samples
+                                                        + z * z / (4 * num_samples * num_samples)) ** 0.5
+        # Every distinct valid plan drawn is one that certainly exists
+        lower = max(len(accepted), int(total * max(0.0, center - half_width)))
+        upper = min(total, int(total * min(1.0, center + half_width)) + 1)
+        return PlanCountEstimate(int(round(total * share)), lower, upper, False,
+                                 num_samples=num_samples, num_accepted=num_accepted)
+
+    def sample(self, k, weight_fn=None, distinct=False, max_attempts=None):
+        """
+        Returns up to k random plans (lists of states, first to last).
+        :param weight_fn: See PlanSampler. Uniform if None.
+        :param distinct: Don't return the same plan twice.
+        :param max_attempts: Most plans to draw before giving up and returning fewer than k (draws can be
+                             rejected for repeat visits or, with distinct, for being drawn already). Defaults to
+                             100 * k.
+        """
+        if weight_fn is None:
+            sampler = self._uniform_sampler
+        else:
+            sampler = self._weighted_sampler
+            if sampler is None or sampler.weight_fn is not weight_fn:
+                sampler = PlanSampler(self.final_states, weight_fn=weight_fn, rng=self.rng)
+                self._weighted_sampler = sampler
+        if k <= 0 or not sampler.total:
+            return []
+        max_attempts = max_attempts if max_attempts is not None else 100 * k
+        plans = []
+        seen = set()
+        for _ in range(max_attempts):
+            path = sampler.sample()
+            if self.rejects_repeat_visits and _has_repeat_visit(path):
+                continue
+            if distinct:
+                key = tuple(id(state) for state in path)
+                if key in seen:
+                    continue
+                seen.add(key)
+            plans.append(path)
+            if len(plans) >= k:
+                break
+        return plans
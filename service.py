@@ -0,0 +1,267 @@
+"""
+Long-running planner service: one shared, read-only graph per city and a process pool that runs many users'
+plan requests against them.
+
+Each city's graph lives in a snapshot file (see snapshot.py). Workers memory-map it the first time they get a
+request for that city, so every worker shares the same physical pages and nothing is rebuilt per request.
+Requests carry their own category sequence, start times and limits, which become constraints on the shared
+graph, so the graph should be built without a category_sequence (only distance / node filters):
+
+    with PlannerService(max_workers=4, max_pending=64) as service:
+        service.add_city("nyc", build_entity_graph(entities, max_distance=1000))
+        result = service.plan(PlanRequest("nyc", [["coffee"], ["museums"], ["bars"]], start_dts, deadline=2.0))
+        print(result.total_seconds, len(result.plans))
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from algo import PlanState, build_initial_states
+from constraints import StateConstraints
+from plan import iter_plans
+from shortcuts import category_sequence_search_fns
+from snapshot import load_graph, save_graph
+from timing import Timeline
+
+
+class PlannerOverloadedException(Exception):
+    def __init__(self, num_pending):
+        message = "Planner is overloaded ({} requests pending), try again later".format(num_pending)
+        super(Exception, self).__init__(message)
+
+
+class UnknownCityException(Exception):
+    def __init__(self, city):
+        message = "No graph loaded for city {}".format(city)
+        super(Exception, self).__init__(message)
+
+
+class PlanRequest:
+    """
+    One user's request for plans that visit a place from each entry of category_sequence in order.
+    :param start_dts: Possible start times.
+    :param deadline: Seconds from submission the request must finish within. The search stops there and returns
+                     the plans found so far. None for no deadline.
+    :param max_results: Stop after finding this many plans.
+    :param time_spent_fn: Dwell options (see build_neighbor_state_fn). Must be module level so workers can use it.
+    """
+    def __init__(self, city, category_sequence, start_dts, no_repeat_visits=True, max_results=None, deadline=None,
+                 time_spent_fn=None, require_open_throughout=False):
+        self.city = city
+        self.category_sequence = category_sequence
+        self.start_dts = list(start_dts)
+        self.no_repeat_visits = no_repeat_visits
+        self.max_results = max_results
+        self.deadline = deadline
+        self.time_spent_fn = time_spent_fn
+        self.require_open_throughout = require_open_throughout
+
+
+class PlanResult:
+    """
+    The plans found for a PlanRequest (success states on the service's graph for the city) and where the time
+    went: waiting for a worker (queue_seconds), searching (search_seconds) and in total, end to end.
+    """
+    def __init__(self, request, plans, timed_out, submitted_at, started_at, finished_at, completed_at):
+        self.request = request
+        self.plans = plans
+        self.timed_out = timed_out
+        self.queue_seconds = max(0.0, started_at - submitted_at)
+        self.search_seconds = max(0.0, finished_at - started_at)
+        self.total_seconds = max(0.0, completed_at - submitted_at)
+
+
+# Per-process graphs for the service's workers, by snapshot path
+_worker_graphs = {}
+
+
+def _worker_graph(snapshot_path):
+    graph = _worker_graphs.get(snapshot_path)
+    if graph is None:
+        graph = load_graph(snapshot_path)
+        _worker_graphs[snapshot_path] = graph
+    return graph
+
+
+def _run_plan_request(snapshot_path, request, deadline_at):
+    # Runs in a worker. Returns (started_at, finished_at, timed_out, paths) with each plan as a list of
+    # (node index, start minute, end minute), which the service turns back into states on its own graph.
+    started_at = time.time()
+    if deadline_at is not None and started_at >= deadline_at:
+        return started_at, started_at, True, []
+    graph = _worker_graph(snapshot_path)
+    node_ids = graph.node_ids
+    sequence = request.category_sequence
+    neighbor_state_fn, success_state_fn = category_sequence_search_fns(
+        sequence,
+        no_repeat_visits=request.no_repeat_visits,
+        time_spent_fn=request.time_spent_fn,
+        require_open_throughout=request.require_open_throughout)
+    initial_states = build_initial_states(graph, request.start_dts,
+                                          StateConstraints().curr_state_category_in(sequence[0]),
+                                          time_spent_fn=request.time_spent_fn,
+                                          require_open_throughout=request.require_open_throughout)
+    timeout = deadline_at - time.time() if deadline_at is not None else None
+    paths = []
+    for state in iter_plans(graph, initial_states, neighbor_state_fn, success_state_fn,
+                            max_results=request.max_results, timeout=timeout):
+        paths.append([(node_ids[s.node], s.start, s.end) for s in state.prev_state_list() + [state]])
+    finished_at = time.time()
+    timed_out = deadline_at is not None and finished_at >= deadline_at
+    return started_at, finished_at, timed_out, paths
+
+
+class PlannerService:
+    """
+    Runs PlanRequests on a pool of worker processes against shared per-city graphs.
+    Admission control: at most max_pending requests can be queued or running at once, submitting more raises
+    PlannerOverloadedException right away so callers can shed load instead of queueing without bound.
+    """
+    def __init__(self, max_workers=None, max_pending=64, snapshot_dir=None):
+        """
+        :param max_workers: Worker processes (defaults to the number of CPUs).
+        :param max_pending: Most requests queued or running at once.
+        :param snapshot_dir: Where to write snapshots of graphs given to add_city. Defaults to a temporary
+                             directory removed on close().
+        """
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+        self.max_pending = max_pending
+        self._owns_snapshot_dir = snapshot_dir is None
+        self.snapshot_dir = snapshot_dir if snapshot_dir is not None else tempfile.mkdtemp(prefix="planner-")
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self._cities = {}
+        self._lock = threading.Lock()
+        self._num_pending = 0
+        self.num_completed = 0
+        self.num_rejected = 0
+        self.num_timed_out = 0
+        self.num_failed = 0
+        # Total latency of recent requests, for stats()
+        self._latencies = []
+        self._max_latencies = 1000
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add_city(self, city, graph):
+        """
+        Makes a city's graph available to requests, replacing any graph it had. Requests already submitted keep
+        using the old graph.
+        :param graph: A Graph / CSRGraph (saved to a snapshot in snapshot_dir), or the path of a snapshot.
+        """
+        if isinstance(graph, str):
+            path = graph
+        else:
+            # A new file every time. Workers keep graphs by path and may still have an older snapshot mapped,
+            # so a path is never reused, even when a city's graph is replaced.
+            fd, path = tempfile.mkstemp(suffix=".graph", dir=self.snapshot_dir)
+            os.close(fd)
+            save_graph(graph, path)
+        # The service's own view of the graph, to turn worker results back into states
+        self._cities[city] = (path, load_graph(path))
+
+    def submit(self, request):
+        """
+        Queues a request and returns a concurrent.futures.Future resolving to its PlanResult.
+        Raises PlannerOverloadedException if max_pending requests are already in flight.
+        """
+        if request.city not in self._cities:
+            raise UnknownCityException(request.city)
+        path, graph = self._cities[request.city]
+        with self._lock:
+            if self._num_pending >= self.max_pending:
+                self.num_rejected += 1
+                raise PlannerOverloadedException(self._num_pending)
+            self._num_pending += 1
+        submitted_at = time.time()
+        deadline_at = submitted_at + request.deadline if request.deadline is not None else None
+        try:
+            worker_future = self._executor.submit(_run_plan_request, path, request, deadline_at)
+        except BaseException:
+            # Never queued (broken pool, or the service was closed), so give its slot back
+            with self._lock:
+                self._num_pending -= 1
+            raise
+
+        # Chain a future for the PlanResult so the plans are rebuilt on the service's graph
+        future = Future()
+        def on_done(done):
+            try:
+                started_at, finished_at, timed_out, paths = done.result()
+                plans = self._rebuild_plans(graph, request, paths)
+                result = PlanResult(request, plans, timed_out, submitted_at, started_at, finished_at, time.time())
+            except BaseException as e:
+                self._finish(None)
+                future.set_exception(e)
+                return
+            self._finish(result)
+            future.set_result(result)
+        worker_future.add_done_callback(on_done)
+        return future
+
+    def plan(self, request):
+        """
+        Blocking version of submit.
+        """
+        return self.submit(request).result()
+
+    def _rebuild_plans(self, graph, request, paths):
+        timeline = Timeline(min(request.start_dts))
+        nodes = graph.nodes
+        # Plans sharing a prefix share its states, like in a search
+        built_states = {}
+        plans = []
+        for path in paths:
+            state = None
+            key = ()
+            for node_id, start, end in path:
+                key += ((node_id, start, end),)
+                next_state = built_states.get(key)
+                if next_state is None:
+                    next_state = PlanState(nodes[node_id], start, end, state, len(key) - 1, timeline)
+                    built_states[key] = next_state
+                state = next_state
+            plans.append(state)
+        return plans
+
+    def _finish(self, result):
+        with self._lock:
+            self._num_pending -= 1
+            if result is None:
+                self.num_failed += 1
+                return
+            self.num_completed += 1
+            if result.timed_out:
+                self.num_timed_out += 1
+            self._latencies.append(result.total_seconds)
+            if len(self._latencies) > self._max_latencies:
+                del self._latencies[:len(self._latencies) - self._max_latencies]
+
+    def stats(self):
+        """
+        Returns request counts and latency percentiles (seconds) over the last 1000 completed requests.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            out = {
+                "pending": self._num_pending,
+                "completed": self.num_completed,
+                "rejected": self.num_rejected,
+                "timed_out": self.num_timed_out,
+                "failed": self.num_failed,
+            }
+        for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            out["latency_" + name] = latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else None
+        return out
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._owns_snapshot_dir:
+            shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
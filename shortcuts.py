@@ -1,7 +1,9 @@
-from utils import dedupe_list
-from algo import Entity
+from utils import dedupe_list, lat_long_dists
+from algo import Entity, build_neighbor_state_fn, build_success_state_fn
+from constraints import BooleanConstraints, StateConstraints, UberConstraints
+import asyncio
 import urllib
-import math
+import numpy as np
 
 def fetch_businesses_by_categories(api,
                                    location,
@@ -27,14 +29,66 @@ def fetch_businesses_by_categories(api,
     businesses = dedupe_list(businesses, lambda x: x.id)
 
     if add_hours:
-        # Add hours in groups of 20 to reduce load
-        for i in range(0, int(math.ceil(len(businesses)/20))):
-            api.add_hours_to_search_results(businesses[i*20:(i+1)*20])
+        api.add_hours_to_search_results(businesses)
 
     if as_entities:
         businesses = [Entity(business=b) for b in businesses]
     return businesses
 
+async def fetch_businesses_by_categories_async(api,
+                                               location,
+                                               categories,
+                                               num_businesses_per_category=20,
+                                               request_separately=True,
+                                               add_hours=True,
+                                               as_entities=True):
+    """
+    Same as fetch_businesses_by_categories for an AsyncYelpAPI, but the per-category searches and the hours
+    lookups run concurrently.
+    """
+    if request_separately:
+        all_results = await asyncio.gather(*[api.business_search(location=location,
+                                                                 categories=[cat],
+                                                                 add_parent_categories=True,
+                                                                 max_num_businesses=num_businesses_per_category)
+                                             for cat in categories])
+    else:
+        all_results = [await api.business_search(location=location,
+                                                 categories=categories,
+                                                 add_parent_categories=True,
+                                                 max_num_businesses=num_businesses_per_category * len(categories))]
+    businesses = []
+    for results in all_results:
+        businesses.extend(results['businesses'])
+    businesses = dedupe_list(businesses, lambda x: x.id)
+
+    if add_hours:
+        await api.add_hours_to_search_results(businesses)
+
+    if as_entities:
+        businesses = [Entity(business=b) for b in businesses]
+    return businesses
+
+def category_sequence_search_fns(category_sequence, no_repeat_visits=True, time_spent_fn=None,
+                                 require_open_throughout=False):
+    """
+    Builds the (neighbor_state_fn, success_state_fn) pair for plans that visit one place from each entry of
+    category_sequence in order. Module level so it can be passed to plan.generate_plans_parallel.
+    :param time_spent_fn: See build_neighbor_state_fn. Must be picklable (module level) to use it in another process.
+    :param require_open_throughout: See build_neighbor_state_fn.
+    """
+    b, s, u = BooleanConstraints(), StateConstraints(), UberConstraints()
+    constraints = [u.follows_cat_sequence(category_sequence)]
+    if no_repeat_visits:
+        constraints.append(s.no_repeat_visits())
+    neighbor_state_fn = build_neighbor_state_fn(b.bool_and(constraints),
+                                                time_spent_fn=time_spent_fn,
+                                                require_open_throughout=require_open_throughout)
+    # Successful once the last category in the sequence has been reached
+    success_constraints = {i: b.bool_false() for i in range(len(category_sequence) - 1)}
+    success_state_fn = build_success_state_fn(s.prev_state_dependent(success_constraints))
+    return neighbor_state_fn, success_state_fn
+
 def build_maps_link(places, travelmode):
     origin = places[0]
     dest = places[-1]
@@ -52,10 +106,36 @@ def build_maps_link(places, travelmode):
     return url
 
 def plan_total_distance(graph, final_state):
-    states = final_state.prev_state_list() + [final_state]
+    return plans_total_distances(graph, [final_state])[0]
+
+def plans_total_distances(graph, final_states):
+    """
+    Returns the total distance (meters) travelled in each plan, computing every leg of every plan
+    in one batch.
+    """
+    from_lats, from_lons, to_lats, to_lons, plan_idxs = [], [], [], [], []
+    for plan_idx, final_state in enumerate(final_states):
+        states = final_state.prev_state_list() + [final_state]
+        for i in range(len(states) - 1):
+            bizA, bizB = states[i].node.entity, states[i + 1].node.entity
+            from_lats.append(bizA.latitude)
+            from_lons.append(bizA.longitude)
+            to_lats.append(bizB.latitude)
+            to_lons.append(bizB.longitude)
+            plan_idxs.append(plan_idx)
+    dists = lat_long_dists(from_lats, from_lons, to_lats, to_lons)
+    return np.bincount(np.asarray(plan_idxs, dtype=int), weights=dists, minlength=len(final_states)).tolist()
+
+def plan_distance_so_far(graph, state):
+    """
+    Distance (meters) travelled so far in a (possibly partial) plan, using the distances stored on the graph
+    edges. Never decreases as a plan grows, so it's also a lower bound for top_k_plans.
+    """
     dist = 0
-    for i in range(len(states) - 1):
-        dist += graph.get_edge_properties(states[i].node, states[i + 1].node)['dist']
+    prev_state = state
+    while prev_state.prev_state is not None:
+        dist += graph.get_edge_properties(prev_state.prev_state.node, prev_state.node)['dist']
+        prev_state = prev_state.prev_state
     return dist
 
 def sort_plans_by(states, sort_fn):
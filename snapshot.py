@@ -0,0 +1,174 @@
+"""
+Saving built entity graphs to a versioned binary file and memory-mapping them back.
+
+Layout (little endian):
+    8 bytes     magic b"DPGRAPH\\0"
+    uint32      format version
+    uint32      header length
+    header      UTF-8 JSON: counts, category aliases and where each section is (offsets relative to the data start)
+    padding     to a multiple of ALIGNMENT
+    data        numeric arrays, each starting on a multiple of ALIGNMENT, then the pickled entities
+
+The CSR adjacency and edge distances are used straight from the read-only mapping, so processes loading the same
+file share those pages. Everything per node is rebuilt in each process: the entities are unpickled, and each one
+gets its compiled opening hours (a HoursIndex of Python lists, which the hours checks binary search faster than
+numpy arrays) and category mask from the stored arrays. That skips parsing hours and interning categories again,
+but loading still takes time and memory in proportion to the number of nodes.
+"""
+import json
+import mmap
+import pickle
+import struct
+
+import numpy as np
+
+from algo import Entity, EntityTypes
+from categories import default_category_index
+from graph import CSRGraph
+from hours import HoursIndex
+
+MAGIC = b"DPGRAPH\0"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct("<8sII")
+
+
+class SnapshotFormatException(Exception):
+    def __init__(self, path, reason):
+        message = "Can't load graph snapshot {0}: {1}".format(path, reason)
+        super(Exception, self).__init__(message)
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _entity_record(entity):
+    # The raw business / event only. Compiled hours and categories are stored as arrays, and the category
+    # index is shared, so neither should go through pickle.
+    return (entity.type, entity.entity)
+
+
+def save_graph(graph, path):
+    """
+    Writes a Graph or CSRGraph (nodes, adjacency, edge distances, compiled hours and categories) to path.
+    Load it with load_graph.
+    """
+    if not isinstance(graph, CSRGraph):
+        graph = CSRGraph.from_graph(graph)
+    nodes = graph.nodes
+
+    # Opening hours of every node, concatenated, with node i's intervals at hours_offsets[i]:hours_offsets[i + 1]
+    hours_offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    hours_starts, hours_ends = [], []
+    # Categories as ids into category_aliases, laid out the same way
+    category_ids = {}
+    category_aliases = []
+    category_offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    node_categories = []
+    for i, node in enumerate(nodes):
+        if node.type == EntityTypes.BUSINESS and node.entity.hours is not None:
+            hours_starts.extend(node.hours_index.starts)
+            hours_ends.extend(node.hours_index.ends)
+        hours_offsets[i + 1] = len(hours_starts)
+        for alias in sorted(node.entity.categories or ()):
+            if alias not in category_ids:
+                category_ids[alias] = len(category_aliases)
+                category_aliases.append(alias)
+            node_categories.append(category_ids[alias])
+        category_offsets[i + 1] = len(node_categories)
+
+    arrays = {
+        "offsets": np.asarray(graph.offsets, dtype="<i8"),
+        "neighbors": np.asarray(graph.neighbors, dtype="<i4"),
+        "hours_offsets": hours_offsets.astype("<i8"),
+        "hours_starts": np.asarray(hours_starts, dtype="<i4"),
+        "hours_ends": np.asarray(hours_ends, dtype="<i4"),
+        "category_offsets": category_offsets.astype("<i8"),
+        "category_ids": np.asarray(node_categories, dtype="<i4"),
+    }
+    for name, values in graph.edge_attrs.items():
+        arrays["edge_attr:" + name] = np.asarray(values, dtype="<f8")
+    entities_blob = pickle.dumps([_entity_record(node) for node in nodes], protocol=pickle.HIGHEST_PROTOCOL)
+
+    sections = {}
+    offset = 0
+    for name, values in arrays.items():
+        offset = _align(offset)
+        sections[name] = {"offset": offset, "dtype": values.dtype.str, "length": len(values)}
+        offset += values.nbytes
+    offset = _align(offset)
+    entities_section = {"offset": offset, "length": len(entities_blob)}
+
+    header = json.dumps({
+        "num_nodes": len(nodes),
+        "num_edges": graph.num_edges(),
+        "category_aliases": category_aliases,
+        "arrays": sections,
+        "entities": entities_section,
+    }).encode("utf-8")
+    data_start = _align(_PREAMBLE.size + len(header))
+
+    with open(path, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for name, values in arrays.items():
+            f.seek(data_start + sections[name]["offset"])
+            f.write(values.tobytes())
+        f.seek(data_start + entities_section["offset"])
+        f.write(entities_blob)
+
+
+def load_graph(path, category_index=None):
+    """
+    Memory-maps a snapshot written by save_graph and returns it as a read-only CSRGraph. The adjacency and edge
+    arrays are views of the mapping rather than copies. The entities, their opening hours and categories are
+    copied out into Python objects.
+    :param category_index: CategoryIndex to intern the entities' categories in. Defaults to the default one.
+    """
+    category_index = category_index if category_index is not None else default_category_index()
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mapped) < _PREAMBLE.size:
+        raise SnapshotFormatException(path, "file is too short")
+    magic, version, header_length = _PREAMBLE.unpack_from(mapped, 0)
+    if magic != MAGIC:
+        raise SnapshotFormatException(path, "not a graph snapshot")
+    if version != FORMAT_VERSION:
+        raise SnapshotFormatException(path, "unsupported format version {}".format(version))
+    header = json.loads(bytes(mapped[_PREAMBLE.size:_PREAMBLE.size + header_length]).decode("utf-8"))
+    data_start = _align(_PREAMBLE.size + header_length)
+
+    arrays = {}
+    for name, section in header["arrays"].items():
+        arrays[name] = np.frombuffer(mapped, dtype=np.dtype(section["dtype"]), count=section["length"],
+                                     offset=data_start + section["offset"])
+    entities_section = header["entities"]
+    entities_start = data_start + entities_section["offset"]
+    records = pickle.loads(mapped[entities_start:entities_start + entities_section["length"]])
+
+    # Rebuild the entities with their hours and categories already compiled
+    alias_ids = [category_index.intern(alias) for alias in header["category_aliases"]]
+    # Copied to lists once, rather than per node
+    hours_offsets = arrays["hours_offsets"].tolist()
+    hours_starts = arrays["hours_starts"].tolist()
+    hours_ends = arrays["hours_ends"].tolist()
+    category_offsets = arrays["category_offsets"].tolist()
+    category_ids = arrays["category_ids"].tolist()
+    nodes = []
+    for i, (entity_type, raw) in enumerate(records):
+        if entity_type == EntityTypes.BUSINESS:
+            node = Entity(business=raw, category_index=category_index)
+            start, end = hours_offsets[i], hours_offsets[i + 1]
+            if raw.hours is not None:
+                node._hours_index = HoursIndex.from_intervals(hours_starts[start:end], hours_ends[start:end])
+        else:
+            node = Entity(event=raw, category_index=category_index)
+        mask = 0
+        for category_id in category_ids[category_offsets[i]:category_offsets[i + 1]]:
+            mask |= 1 << alias_ids[category_id]
+        node._category_mask = mask
+        nodes.append(node)
+
+    edge_attrs = {name[len("edge_attr:"):]: values for name, values in arrays.items() if name.startswith("edge_attr:")}
+    return CSRGraph(nodes, arrays["offsets"], arrays["neighbors"], edge_attrs)
@@ -0,0 +1,113 @@
+"""
+Optional instrumentation for plan searches. Pass a SearchStats to build_neighbor_state_fn and iter_plans /
+generate_plans (or layered.LayeredSearch.run) to find out where a search spends its time. When no SearchStats
+is given the counting and timing is skipped, so it costs next to nothing unless it's asked for.
+"""
+import time
+
+
+class SearchStats:
+    """
+    Counters and timings from a search:
+    - states_popped / success_states / neighbors_generated: states taken off the queue, the ones that were
+      success states and the neighbor states that passed every check.
+    - candidates: next states considered (one per edge and dwell option reached while open).
+    - rejected_closed_on_arrival: edges skipped because the place is closed when we'd get there.
+    - rejected_closed_on_departure: dwell options rejected because the place closes before we'd leave (or
+      during the visit, with require_open_throughout).
+    - rejected_by_constraint: candidates the neighbor constraint rejected. Wrap parts of the constraint
+      with named() to see which part rejects them.
+    - constraint_calls / constraint_rejections / constraint_seconds: per name, for constraints wrapped by
+      named().
+    - neighbor_seconds / open_hours_seconds: total time in neighbor_state_fn and the opening hours checks in it.
+    - frontier_samples: (elapsed seconds, states popped, queue size) every sample_interval states popped.
+    """
+    def __init__(self, sample_interval=1000, callback=None):
+        """
+        :param sample_interval: Record the frontier (and call callback) every this many states popped.
+        :param callback: Optional fn(stats, event) called with event "sample" at every frontier sample and "done"
+                         when the search ends, e.g. to push the numbers to a metrics pipeline.
+        """
+        self.sample_interval = sample_interval
+        self.callback = callback
+        self.states_popped = 0
+        self.success_states = 0
+        self.neighbors_generated = 0
+        self.candidates = 0
+        self.rejected_closed_on_arrival = 0
+        self.rejected_closed_on_departure = 0
+        self.rejected_by_constraint = 0
+        self.constraint_calls = {}
+        self.constraint_rejections = {}
+        self.constraint_seconds = {}
+        self.neighbor_seconds = 0.0
+        self.open_hours_seconds = 0.0
+        self.frontier_samples = []
+        self.start_time = None
+        self.elapsed = 0.0
+
+    def named(self, name, constraint):
+        """
+        Returns constraint wrapped to count its calls and rejections and time it under name.
+        """
+        self.constraint_calls.setdefault(name, 0)
+        self.constraint_rejections.setdefault(name, 0)
+        self.constraint_seconds.setdefault(name, 0.0)
+        calls, rejections, seconds = self.constraint_calls, self.constraint_rejections, self.constraint_seconds
+        timer = time.perf_counter
+
+        def named_constraint_fn(constraint_params):
+            start = timer()
+            result = constraint(constraint_params)
+            seconds[name] += timer() - start
+            calls[name] += 1
+            if not result:
+                rejections[name] += 1
+            return result
+        return named_constraint_fn
+
+    def named_and(self, named_constraints):
+        """
+        Same as BooleanConstraints.bool_and over a dict of name -> constraint, with each part wrapped by named(),
+        so rejections are attributed to the first part that fails.
+        """
+        constraints = [self.named(name, constraint) for name, constraint in named_constraints.items()]
+        def named_and_fn(constraint_params):
+            for c in constraints:
+                if not c(constraint_params):
+                    return False
+            return True
+        return named_and_fn
+
+    def start(self):
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+
+    def sample_frontier(self, queue_size):
+        self.elapsed = time.perf_counter() - self.start_time
+        self.frontier_samples.append((self.elapsed, self.states_popped, queue_size))
+        if self.callback is not None:
+            self.callback(self, "sample")
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.start_time
+        if self.callback is not None:
+            self.callback(self, "done")
+
+    def as_dict(self):
+        return {
+            "states_popped": self.states_popped,
+            "success_states": self.success_states,
+            "neighbors_generated": self.neighbors_generated,
+            "candidates": self.candidates,
+            "rejected_closed_on_arrival": self.rejected_closed_on_arrival,
+            "rejected_closed_on_departure": self.rejected_closed_on_departure,
+            "rejected_by_constraint": self.rejected_by_constraint,
+            "constraint_calls": dict(self.constraint_calls),
+            "constraint_rejections": dict(self.constraint_rejections),
+            "constraint_seconds": dict(self.constraint_seconds),
+            "neighbor_seconds": self.neighbor_seconds,
+            "open_hours_seconds": self.open_hours_seconds,
+            "frontier_samples": list(self.frontier_samples),
+            "elapsed": self.elapsed,
+        }
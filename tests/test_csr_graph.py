@@ -0,0 +1,32 @@
+import datetime
+import os
+
+from algo import Entity, EntityGraphBuilder, build_initial_states
+from benchmarks.synthetic_city import DAY_OUT_SEQUENCE, generate_city
+from constraints import StateConstraints
+from graph import CSRGraph
+from plan import generate_plans
+from shortcuts import category_sequence_search_fns
+from snapshot import load_graph, save_graph
+
+SEQUENCE = DAY_OUT_SEQUENCE[:2]
+START_DTS = [datetime.datetime(2020, 6, 6, 10)]
+
+
+def _plans(graph):
+    initial_states = build_initial_states(graph, START_DTS, StateConstraints().curr_state_category_in(SEQUENCE[0]))
+    return list(generate_plans(graph, initial_states, *category_sequence_search_fns(SEQUENCE), None))
+
+
+def test_graph_without_edges(tmpdir):
+    businesses, _ = generate_city(20, seed=1)
+    graph = EntityGraphBuilder(max_distance=-1).build([Entity(business=b) for b in businesses])
+    assert not graph.edge_properties
+
+    csr = CSRGraph.from_graph(graph)
+    assert "dist" in csr.edge_attrs
+    assert _plans(csr) == []
+
+    path = os.path.join(str(tmpdir), "empty.graph")
+    save_graph(csr, path)
+    assert _plans(load_graph(path)) == []
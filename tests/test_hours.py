@@ -0,0 +1,46 @@
+import datetime
+
+from hours import HoursIndex
+
+
+def _span(start, end, is_overnight=False):
+    return {"start": datetime.time(*start), "end": datetime.time(*end), "is_overnight": is_overnight}
+
+
+def _week(monday=(), sunday=()):
+    return [list(monday)] + [[] for _ in range(5)] + [list(sunday)]
+
+
+# 2020-06-01 is a Monday, 2020-06-07 a Sunday
+MONDAY = datetime.datetime(2020, 6, 1)
+SUNDAY = datetime.datetime(2020, 6, 7)
+
+
+def test_overnight_span():
+    index = HoursIndex(_week(monday=[_span((20, 0), (2, 0), is_overnight=True)]))
+    assert not index.open_at(MONDAY.replace(hour=19, minute=59))
+    assert index.open_at(MONDAY.replace(hour=23))
+    assert index.open_at(MONDAY + datetime.timedelta(days=1, hours=1, minutes=30))
+    assert not index.open_at(MONDAY + datetime.timedelta(days=1, hours=2, minutes=1))
+    assert index.open_between(MONDAY.replace(hour=21), MONDAY + datetime.timedelta(days=1, hours=2))
+
+
+def test_span_closing_at_midnight():
+    # Not marked overnight, but ending before it starts means it runs up to midnight
+    index = HoursIndex(_week(monday=[_span((18, 0), (0, 0))]))
+    assert not index.open_at(MONDAY.replace(hour=12))
+    assert index.open_at(MONDAY.replace(hour=18))
+    assert index.open_at(MONDAY.replace(hour=23, minute=59))
+    assert index.open_between(MONDAY.replace(hour=18), MONDAY + datetime.timedelta(days=1))
+    assert not index.open_at(MONDAY + datetime.timedelta(days=1, minutes=1))
+
+
+def test_sunday_night_runs_into_monday():
+    index = HoursIndex(_week(monday=[_span((0, 0), (3, 0))], sunday=[_span((22, 0), (0, 0), is_overnight=True)]))
+    assert index.open_at(SUNDAY.replace(hour=23))
+    assert index.open_at(MONDAY.replace(hour=1))
+    assert index.open_at(SUNDAY + datetime.timedelta(days=1, hours=2))
+    # Sunday night and early Monday are merged, so open throughout across the end of the week
+    assert index.open_between(SUNDAY.replace(hour=22), SUNDAY + datetime.timedelta(days=1, hours=3))
+    assert not index.open_between(SUNDAY.replace(hour=22), SUNDAY + datetime.timedelta(days=1, hours=4))
+    assert not index.open_at(SUNDAY.replace(hour=21))
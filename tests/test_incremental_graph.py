@@ -0,0 +1,46 @@
+import datetime
+
+from algo import Entity, EntityGraphBuilder, build_initial_states
+from benchmarks.synthetic_city import DAY_OUT_SEQUENCE, generate_city
+from constraints import StateConstraints
+from plan import generate_plans
+from shortcuts import category_sequence_search_fns
+
+SEQUENCE = DAY_OUT_SEQUENCE[:3]
+START_DTS = [datetime.datetime(2020, 6, 6, 10), datetime.datetime(2020, 6, 6, 13)]
+
+
+def _plans(graph, neighbor_state_fn, success_state_fn):
+    initial_states = build_initial_states(graph, START_DTS, StateConstraints().curr_state_category_in(SEQUENCE[0]))
+    plans = generate_plans(graph, initial_states, neighbor_state_fn, success_state_fn, None)
+    return {tuple((s.node.entity.id, s.start, s.end) for s in state.prev_state_list() + [state]) for state in plans}
+
+
+def _rebuilt_plans(builder, entities):
+    return _plans(builder.build(entities), *category_sequence_search_fns(SEQUENCE))
+
+
+def test_reused_neighbor_fn_sees_removed_and_added_entities():
+    businesses, _ = generate_city(150, seed=4)
+    entities = [Entity(business=b) for b in businesses]
+    builder = EntityGraphBuilder(max_distance=800)
+    graph = builder.build(entities[:-1])
+    neighbor_state_fn, success_state_fn = category_sequence_search_fns(SEQUENCE)
+    plans = _plans(graph, neighbor_state_fn, success_state_fn)
+    assert plans
+
+    # Remove a place that's visited mid-plan, searching again with the same neighbor_state_fn
+    removed_id = next(iter(plans))[1][0]
+    removed = next(e for e in entities if e.entity.id == removed_id)
+    assert builder.remove_entity(graph, removed)
+    remaining = [e for e in entities[:-1] if e is not removed]
+    plans = _plans(graph, neighbor_state_fn, success_state_fn)
+    assert all(removed_id not in (stop[0] for stop in plan) for plan in plans)
+    assert plans == _rebuilt_plans(builder, remaining)
+
+    # Add it back along with a place the graph never had
+    assert builder.add_entity(graph, removed)
+    assert builder.add_entity(graph, entities[-1])
+    plans = _plans(graph, neighbor_state_fn, success_state_fn)
+    assert any(removed_id in (stop[0] for stop in plan) for plan in plans)
+    assert plans == _rebuilt_plans(builder, remaining + [removed, entities[-1]])
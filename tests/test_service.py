@@ -0,0 +1,33 @@
+import datetime
+
+from algo import Entity, build_entity_graph, build_initial_states
+from benchmarks.synthetic_city import DAY_OUT_SEQUENCE, generate_city
+from constraints import StateConstraints
+from plan import generate_plans
+from service import PlannerService, PlanRequest
+from shortcuts import category_sequence_search_fns
+
+SEQUENCE = DAY_OUT_SEQUENCE[:2]
+START_DTS = [datetime.datetime(2020, 6, 6, 10), datetime.datetime(2020, 6, 6, 13)]
+
+
+def _plan_keys(states):
+    return {tuple((s.node.entity.id, s.start, s.end) for s in state.prev_state_list() + [state]) for state in states}
+
+
+def _expected_plans(graph):
+    initial_states = build_initial_states(graph, START_DTS, StateConstraints().curr_state_category_in(SEQUENCE[0]))
+    return _plan_keys(generate_plans(graph, initial_states, *category_sequence_search_fns(SEQUENCE), None))
+
+
+def test_readded_city_uses_latest_graph():
+    businesses, _ = generate_city(150, seed=2)
+    entities = [Entity(business=b) for b in businesses]
+    graphs = [build_entity_graph(entities, max_distance=max_distance, compact=True)
+              for max_distance in (400, 800, 1200)]
+    # One worker, so it has every snapshot it loaded cached
+    with PlannerService(max_workers=1) as service:
+        for graph in graphs:
+            service.add_city("city", graph)
+            result = service.plan(PlanRequest("city", SEQUENCE, START_DTS))
+            assert _plan_keys(result.plans) == _expected_plans(graph)
@@ -0,0 +1,34 @@
+import datetime
+
+from algo import Entity, build_entity_graph, build_initial_states
+from benchmarks.synthetic_city import DAY_OUT_SEQUENCE, generate_city
+from constraints import StateConstraints
+from plan import generate_plans, top_k_plans
+from shortcuts import category_sequence_search_fns, plan_distance_so_far, plan_total_distance
+
+SEQUENCE = DAY_OUT_SEQUENCE[:3]
+# Every half hour, so the same places are often visited in the same order at different times
+START_DTS = [datetime.datetime(2020, 6, 6, 10) + datetime.timedelta(minutes=30 * i) for i in range(8)]
+
+
+def _search(num_places):
+    businesses, _ = generate_city(num_places, seed=0)
+    graph = build_entity_graph([Entity(business=b) for b in businesses], max_distance=1000)
+    initial_states = build_initial_states(graph, START_DTS, StateConstraints().curr_state_category_in(SEQUENCE[0]))
+    return graph, initial_states, category_sequence_search_fns(SEQUENCE)
+
+
+def test_tied_scores():
+    graph, initial_states, (neighbor_state_fn, success_state_fn) = _search(200)
+    best = top_k_plans(graph, initial_states, neighbor_state_fn, success_state_fn, plan_total_distance, 5,
+                       bound_fn=plan_distance_so_far)
+    all_scores = sorted(plan_total_distance(graph, state) for state in
+                        generate_plans(graph, initial_states, neighbor_state_fn, success_state_fn, None))
+    assert all_scores[0] == all_scores[1]
+    assert [plan_total_distance(graph, state) for state in best] == all_scores[:5]
+
+
+def test_all_scores_tied():
+    graph, initial_states, (neighbor_state_fn, success_state_fn) = _search(100)
+    best = top_k_plans(graph, initial_states, neighbor_state_fn, success_state_fn, lambda graph, state: 0, 5)
+    assert len(best) == 5
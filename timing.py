@@ -0,0 +1,119 @@
+"""
+Scheduling in whole minutes. Searches place states on a Timeline (integer minutes since an epoch) and read
+travel and dwell times, precomputed per graph, in minutes, so expanding a state is integer arithmetic.
+Datetimes only come back out when a plan is read (PlanState.start_dt / end_dt).
+"""
+import datetime
+
+from hours import MINUTES_PER_WEEK, minute_of_week
+
+_MINUTE = datetime.timedelta(minutes=1)
+
+
+def to_minutes(td):
+    """
+    Returns a timedelta as a whole number of minutes, rounded up.
+    """
+    return -(-td // _MINUTE)
+
+
+class Timeline:
+    """
+    Maps datetimes to whole minutes since an epoch (midnight of the epoch's day) and back.
+    Naive and timezone aware epochs both work. Minutes are added as wall clock time, the same as adding
+    timedeltas to the datetimes would.
+    """
+    def __init__(self, epoch):
+        self.epoch = epoch.replace(hour=0, minute=0, second=0, microsecond=0)
+        # Minute of the week the epoch falls on, for looking up opening hours
+        self.week_offset = int(minute_of_week(self.epoch))
+
+    def to_minute(self, dt, round_up=True):
+        """
+        Returns the minute dt falls in, or the next whole minute if it's partway through one and round_up is set.
+        """
+        delta = dt - self.epoch
+        return -(-delta // _MINUTE) if round_up else delta // _MINUTE
+
+    def to_datetime(self, minute):
+        return self.epoch + datetime.timedelta(minutes=minute)
+
+    def minute_of_week(self, minute):
+        return (self.week_offset + minute) % MINUTES_PER_WEEK
+
+    def __eq__(self, other):
+        return isinstance(other, Timeline) and self.epoch == other.epoch
+
+    def __hash__(self):
+        return hash(self.epoch)
+
+
+class TimingTable:
+    """
+    For each node of a graph, its dwell options (time_spent_fn(node) as a tuple) and its out-edges paired
+    with the travel time along them (distance_time_fn of the edge's "dist"), in whole minutes rounded up.
+    Everything is computed up front unless lazy is True, in which case each node's entries are computed the
+    first time they're asked for.
+    """
+    def __init__(self, graph, time_spent_fn, distance_time_fn, lazy=False):
+        self.graph = graph
+        self.time_spent_fn = time_spent_fn
+        self.distance_time_fn = distance_time_fn
+        self.lazy = lazy
+        self._dwell = {}
+        self._out_edges = {}
+        if not lazy:
+            for node in graph.nodes:
+                self._dwell[node] = self._compute_dwell(node)
+                self._out_edges[node] = self._compute_out_edges(node)
+
+    def _compute_dwell(self, node):
+        return tuple(to_minutes(td) for td in self.time_spent_fn(node))
+
+    def _compute_out_edges(self, node):
+        graph = self.graph
+        distance_time_fn = self.distance_time_fn
+        edge_attrs = getattr(graph, "edge_attrs", None)
+        if edge_attrs is not None:
+            # CSRGraph: read the row's distances straight out of the edge arrays
+            node_id = graph.node_ids.get(node)
+            if node_id is None:
+                return ()
+            start, end = graph.get_edge_range(node_id)
+            nodes = graph.nodes
+            return tuple((nodes[j], to_minutes(distance_time_fn(dist)))
+                         for j, dist in zip(graph.neighbors[start:end].tolist(),
+                                            edge_attrs['dist'][start:end].tolist()))
+        return tuple((next_node, to_minutes(distance_time_fn(graph.get_edge_properties(node, next_node)['dist'])))
+                     for next_node in graph.get_edges(node))
+
+    def dwell_options(self, node):
+        """
+        Returns the possible amounts of time (minutes) to spend at node.
+        """
+        dwell = self._dwell.get(node)
+        if dwell is None:
+            dwell = self._compute_dwell(node)
+            self._dwell[node] = dwell
+        return dwell
+
+    def out_edges(self, node):
+        """
+        Returns a tuple of (neighbor, travel time in minutes) for every edge out of node.
+        """
+        out_edges = self._out_edges.get(node)
+        if out_edges is None:
+            out_edges = self._compute_out_edges(node)
+            self._out_edges[node] = out_edges
+        return out_edges
+
+    def invalidate(self, nodes):
+        """
+        Forgets the entries for nodes (e.g. after their edges changed). They're recomputed when next asked for.
+        """
+        for node in nodes:
+            self._dwell.pop(node, None)
+            self._out_edges.pop(node, None)
+
+    def matches(self, time_spent_fn, distance_time_fn):
+        return self.time_spent_fn is time_spent_fn and self.distance_time_fn is distance_time_fn
@@ -1,4 +1,7 @@
-from math import radians, cos, sin, asin, sqrt
+from math import radians, degrees, cos, sin, asin, sqrt, floor, pi
+import numpy as np
+
+EARTH_RADIUS_M = 6371 * 1000
 
 
 class TIMEZONES:
@@ -21,6 +24,107 @@ def lat_long_dist(lat1, lon1, lat2, lon2):
     r = 6371  # Radius of earth in kilometers. Use 3956 for miles
     return c * r * 1000 # Convert to meters to match Yelp
 
+def _grid_candidate_blocks(coords, max_distance):
+    """
+    Buckets (lat, long) points into a grid whose cells are at least max_distance wide and returns
+    a list of (idxs_A, idxs_B) blocks, one for each pair of same or adjacent cells. Every pair of
+    points within max_distance meters of each other falls in some block (other pairs may too).
+    Returns None if the grid can't rule anything out (e.g. max_distance is half the planet).
+    """
+    if len(coords) == 0:
+        return []
+    # Haversine distance d between two points satisfies d >= R * |dlat|, so points further than
+    # max_distance apart in latitude can't be neighbors.
+    max_dlat = max_distance / EARTH_RADIUS_M
+    if max_dlat >= pi / 2:
+        return None
+    # It also satisfies sin(d / 2R) >= cos(max |lat|) * sin(|dlon| / 2), which bounds dlon.
+    max_abs_lat = max(abs(radians(lat)) for lat, _ in coords)
+    sin_dlon = sin(max_dlat / 2) / cos(max_abs_lat) if max_abs_lat < pi / 2 else 1
+    if sin_dlon >= 1:
+        return None
+    max_dlon = 2 * asin(sin_dlon)
+
+    # Pad cell sizes slightly so floating point error can't drop a pair on a cell boundary
+    lat_cell = degrees(max_dlat) * (1 + 1e-9) + 1e-12
+    # Longitude wraps around, so use a whole number of cells at least max_dlon wide
+    num_lon_cells = int(360 / (degrees(max_dlon) * (1 + 1e-9) + 1e-12))
+    if num_lon_cells < 3:
+        return None
+    lon_cell = 360.0 / num_lon_cells
+
+    cells = {}
+    for idx, (lat, lon) in enumerate(coords):
+        key = (int(floor(lat / lat_cell)), int(floor((lon + 180) / lon_cell)) % num_lon_cells)
+        cells.setdefault(key, []).append(idx)
+
+    blocks = []
+    for (lat_key, lon_key), members in cells.items():
+        for dlat_key in (-1, 0, 1):
+            for dlon_key in (-1, 0, 1):
+                other = cells.get((lat_key + dlat_key, (lon_key + dlon_key) % num_lon_cells))
+                if other is not None:
+                    blocks.append((members, other))
+    return blocks
+
+def lat_long_dists(lats1, lons1, lats2, lons2):
+    """
+    Vectorized lat_long_dist. Calculates the great circle distance (meters) between each pair of
+    points, broadcasting the inputs against each other like any NumPy operation.
+    """
+    lats1, lons1, lats2, lons2 = map(np.radians, (np.asarray(lats1, dtype=float),
+                                                  np.asarray(lons1, dtype=float),
+                                                  np.asarray(lats2, dtype=float),
+                                                  np.asarray(lons2, dtype=float)))
+    a = np.sin((lats2 - lats1) / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a)) * EARTH_RADIUS_M
+
+def lat_long_dist_matrix(lats1, lons1, lats2=None, lons2=None):
+    """
+    Returns the (n, m) matrix of distances (meters) from each of the n points in lats1/lons1 to
+    each of the m points in lats2/lons2. If the second set is omitted, the first is used for both.
+    """
+    if lats2 is None:
+        lats2, lons2 = lats1, lons1
+    lats1, lons1 = np.asarray(lats1, dtype=float), np.asarray(lons1, dtype=float)
+    return lat_long_dists(lats1[:, None], lons1[:, None], lats2, lons2)
+
+def lat_long_dist_to_many(lat, lon, lats, lons):
+    """
+    Returns the distances (meters) from the point (lat, lon) to each of the points in lats/lons.
+    """
+    return lat_long_dists(lat, lon, lats, lons)
+
+def lat_long_dist_within(lats, lons, max_distance, min_distance=0, use_grid=True, block_size=1024):
+    """
+    Sparse distance matrix: finds every ordered pair (i, j), i != j, of points that are between
+    min_distance and max_distance meters apart (inclusive).
+    :param use_grid: If True, bucket points into a lat/long grid so only nearby blocks of points
+                     are compared. Otherwise (or if the grid can't prune anything) the full matrix
+                     is computed, block_size rows at a time.
+    :return: A tuple of arrays (rows, cols, dists).
+    """
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    blocks = None
+    if use_grid:
+        blocks = _grid_candidate_blocks(list(zip(lats.tolist(), lons.tolist())), max_distance)
+    if blocks is None:
+        all_idxs = np.arange(len(lats))
+        blocks = [(all_idxs[i:i + block_size], all_idxs) for i in range(0, len(lats), block_size)]
+
+    out_rows, out_cols, out_dists = [], [], []
+    for members, other in blocks:
+        members, other = np.asarray(members), np.asarray(other)
+        dists = lat_long_dist_matrix(lats[members], lons[members], lats[other], lons[other])
+        keep = (dists <= max_distance) & (dists >= min_distance) & (members[:, None] != other[None, :])
+        row_pos, col_pos = np.nonzero(keep)
+        out_rows.append(members[row_pos])
+        out_cols.append(other[col_pos])
+        out_dists.append(dists[row_pos, col_pos])
+    if len(out_rows) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+    return np.concatenate(out_rows), np.concatenate(out_cols), np.concatenate(out_dists)
+
 def meters_to_miles(meters):
     return 0.00062137 * meters
 